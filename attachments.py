@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+from tempfile import SpooledTemporaryFile
+from typing import AsyncGenerator, Dict, List, Optional
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types.input_file import InputFile
+from redis.exceptions import RedisError
+from get_api_key import async_redis_conn
+from redmine_client import redmine_client, DownloadTooLarge
+from telegram_limiter import limiter
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# Вложения меньше этого размера держим в памяти, остальные - во временном файле
+ATTACHMENT_MEMORY_LIMIT = config['Redmine'].getint(
+    'attachment_memory_limit_bytes', fallback=5 * 1024 * 1024)
+# Больше этого Bot API всё равно не принимает
+TELEGRAM_UPLOAD_LIMIT = 50 * 1024 * 1024
+
+FILE_ID_EXPIRE_TIME_SECONDS = config['Redis'].getint(
+    'file_id_expire_time_seconds', fallback=30 * 24 * 60 * 60)
+FILE_ID_KEY_PREFIX = 'telegram_file'
+
+
+def file_id_key(attachment_id) -> str:
+    return f"{FILE_ID_KEY_PREFIX}:{attachment_id}"
+
+
+class SpooledInputFile(InputFile):
+    """Вложение, скачанное один раз и отдаваемое всем получателям из общей копии."""
+
+    def __init__(self, file: SpooledTemporaryFile, filename: str):
+        super().__init__(filename=filename)
+        self.file = file
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        # Файл общий для параллельных отправок, поэтому смещение у каждого чтения своё
+        offset = 0
+        while True:
+            self.file.seek(offset)
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                break
+            offset += len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+async def download_file_from_redmine(attachment_id, file_name, api_key) -> Optional[SpooledInputFile]:
+    file = SpooledTemporaryFile(max_size=ATTACHMENT_MEMORY_LIMIT)
+    try:
+        status = await redmine_client.download(
+            f"attachments/download/{attachment_id}", api_key, file, TELEGRAM_UPLOAD_LIMIT)
+    except DownloadTooLarge as e:
+        logger.warning("Вложение %s слишком большое для Telegram: %s",
+                       attachment_id, e)
+        file.close()
+        return None
+    except Exception as e:
+        logger.error("Не удалось скачать вложение %s: %s", attachment_id, e)
+        file.close()
+        return None
+
+    if status != 200:
+        logger.error(
+            "Failed to download attachment %s. Status: %s", attachment_id, status)
+        file.close()
+        return None
+
+    return SpooledInputFile(file, file_name)
+
+
+async def get_cached_file_ids(attachment_ids: List[str]) -> Dict[str, str]:
+    """file_id уже загруженных в Telegram вложений Редмайна, одним MGET."""
+    if not attachment_ids:
+        return {}
+    try:
+        file_ids = await async_redis_conn.mget([file_id_key(attach_id) for attach_id in attachment_ids])
+    except RedisError as e:
+        logger.error("Ошибка Redis: %s", e)
+        return {}
+    return {attach_id: file_id for attach_id, file_id in zip(attachment_ids, file_ids) if file_id}
+
+
+class WebhookAttachment:
+    """Вложение одного вебхука.
+
+    Если file_id вложения уже известен, файл отправляется по нему без скачивания
+    из Редмайна. Иначе первая отправка скачивает и загружает файл, а остальные
+    получатели ждут её и переиспользуют полученный file_id.
+    """
+
+    def __init__(self, attachment_id, file_name: str, api_key: str, file_id: str = None):
+        self.attachment_id = attachment_id
+        self.file_name = file_name
+        self.api_key = api_key
+        self.file_id = file_id
+        self.input_file: Optional[SpooledInputFile] = None
+        self.downloaded = False
+        self.users = 0
+        self._upload_lock = asyncio.Lock()
+
+    async def get_input_file(self) -> Optional[SpooledInputFile]:
+        if not self.downloaded:
+            self.downloaded = True
+            self.input_file = await download_file_from_redmine(
+                self.attachment_id, self.file_name, self.api_key)
+        return self.input_file
+
+    async def remember_file_id(self, file_id: str):
+        self.file_id = file_id
+        try:
+            await async_redis_conn.set(file_id_key(self.attachment_id), file_id, ex=FILE_ID_EXPIRE_TIME_SECONDS)
+        except RedisError as e:
+            logger.error("Ошибка Redis: %s", e)
+
+    async def forget_file_id(self):
+        self.file_id = None
+        try:
+            await async_redis_conn.delete(file_id_key(self.attachment_id))
+        except RedisError as e:
+            logger.error("Ошибка Redis: %s", e)
+
+    async def upload(self, bot: Bot, chat_id):
+        async with self._upload_lock:
+            if self.file_id:
+                return False
+
+            input_file = await self.get_input_file()
+            if input_file is None:
+                return True
+
+            sent = await limiter.call(chat_id, bot.send_document, chat_id, document=input_file)
+            if sent.document:
+                await self.remember_file_id(sent.document.file_id)
+            return True
+
+    async def send(self, bot: Bot, chat_id):
+        if not self.file_id and await self.upload(bot, chat_id):
+            return
+
+        file_id = self.file_id
+        try:
+            await limiter.call(chat_id, bot.send_document, chat_id, document=file_id)
+        except TelegramBadRequest as e:
+            # Telegram больше не принимает этот file_id - загружаем файл заново
+            logger.warning("file_id вложения %s отклонён: %s",
+                           self.attachment_id, e)
+            if self.file_id == file_id:
+                await self.forget_file_id()
+            if not await self.upload(bot, chat_id):
+                await limiter.call(chat_id, bot.send_document, chat_id, document=self.file_id)
+
+    def retain(self):
+        self.users += 1
+
+    def release(self):
+        """Закрывает скачанную копию, когда вложение больше никому не нужно."""
+        self.users -= 1
+        if self.users <= 0:
+            self.close()
+
+    def close(self):
+        if self.input_file:
+            self.input_file.close()
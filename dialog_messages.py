@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+import logging
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Union
+from aiogram import BaseMiddleware, Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramBadRequest, TelegramNotFound
+from aiogram.fsm.context import FSMContext
+from aiogram.methods import TelegramMethod
+from aiogram.types import Message, TelegramObject
+
+logger = logging.getLogger(__name__)
+
+# Telegram удаляет не больше 100 сообщений за один вызов deleteMessages
+DELETE_BATCH_SIZE = 100
+
+# Сообщения, отправленные ботом во время обработки текущего апдейта
+_sent_message_ids: ContextVar[Optional[List[int]]] = ContextVar(
+    'sent_message_ids', default=None)
+
+
+class DeleteMessages(TelegramMethod[bool]):
+    """deleteMessages из Bot API 7.0, в aiogram 3.1 его ещё нет."""
+
+    __returning__ = bool
+    __api_method__ = "deleteMessages"
+
+    chat_id: Union[int, str]
+    message_ids: List[int]
+
+
+class SentMessagesMiddleware(BaseRequestMiddleware):
+    """Запоминает id сообщений, которые бот отправил, пока обрабатывал апдейт."""
+
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        response = await make_request(bot, method)
+        sent_message_ids = _sent_message_ids.get()
+        if sent_message_ids is not None and isinstance(response.result, Message):
+            sent_message_ids.append(response.result.message_id)
+        return response
+
+
+class DialogMessagesMiddleware(BaseMiddleware):
+    """Копит в состоянии id входящих и исходящих сообщений диалога создания задачи.
+
+    Диалог начинается с формы задачи (message_id в состоянии), поэтому
+    запоминаются только сообщения новее неё. Пока идёт диалог, у пользователя
+    всегда есть состояние FSM, а его диспетчер уже прочитал (raw_state), так что
+    апдейты вне диалога не читают данные состояния лишний раз.
+    """
+
+    async def __call__(self, handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject, data: Dict[str, Any]) -> Any:
+        if data.get('raw_state') is None:
+            return await handler(event, data)
+
+        sent_message_ids = []
+        token = _sent_message_ids.set(sent_message_ids)
+        try:
+            return await handler(event, data)
+        finally:
+            _sent_message_ids.reset(token)
+            state: Optional[FSMContext] = data.get('state')
+            if state is not None:
+                message_ids = list(sent_message_ids)
+                if isinstance(event, Message):
+                    message_ids.append(event.message_id)
+                await remember_messages(state, message_ids)
+
+
+async def remember_messages(state: FSMContext, message_ids: Iterable[int]):
+    data = await state.get_data()
+    if 'message_id' not in data:
+        return
+    dialog_message_ids = data.get('dialog_message_ids', [])
+    new_ids = [message_id for message_id in message_ids
+               if message_id > data['message_id'] and message_id not in dialog_message_ids]
+    if new_ids:
+        await state.update_data(dialog_message_ids=dialog_message_ids + new_ids)
+
+
+async def delete_messages(bot: Bot, chat_id: int, message_ids: List[int]):
+    """Удаляет сообщения пачками по DELETE_BATCH_SIZE, а если пачкой не вышло - по одному."""
+    for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[start:start + DELETE_BATCH_SIZE]
+        try:
+            await bot(DeleteMessages(chat_id=chat_id, message_ids=batch))
+        except (TelegramBadRequest, TelegramNotFound) as e:
+            logger.warning(
+                "Не удалось удалить сообщения пачкой, удаляю по одному: %s", e)
+            await delete_messages_one_by_one(bot, chat_id, batch)
+
+
+async def delete_messages_one_by_one(bot: Bot, chat_id: int, message_ids: List[int]):
+    for message_id in message_ids:
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message_id)
+        except TelegramNotFound:
+            # Логируем, но игнорируем ошибку "сообщение для удаления не найдено".
+            logger.warning("Сообщение %s не найдено для удаления.", message_id)
+        except TelegramBadRequest as e:
+            # Логируем неожиданные ошибки и продолжаем с другими сообщениями.
+            logger.error("Ошибка при удалении сообщения %s: %s", message_id, e)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from time import time
+from typing import List, Tuple
+from aiogram import BaseMiddleware, Bot
+from aiogram.fsm.storage.base import StorageKey
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+STAGING_DIR = config.get('Telegram', 'staging_dir', fallback=os.path.join(
+    tempfile.gettempdir(), 'redmine-bot-staging'))
+# Сколько файлов одного пользователя может лежать в ожидании отправки в Редмайн
+USER_LIMIT_BYTES = config.getint(
+    'Telegram', 'staging_user_limit_bytes', fallback=100 * 1024 * 1024)
+# Брошенные диалоги чистятся по истечении этого времени, но не раньше, чем истечёт
+# их состояние FSM, которое ещё ссылается на файлы
+STAGING_TTL_SECONDS = max(
+    config.getint('Telegram', 'staging_ttl_seconds', fallback=86400),
+    config.getint('Telegram', 'fsm_state_ttl_seconds', fallback=86400))
+DOWNLOAD_CONCURRENCY = config.getint(
+    'Telegram', 'staging_concurrency', fallback=4)
+
+_download_semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+
+
+def user_dir(key: StorageKey) -> str:
+    """Папка диалога: как и состояние FSM, своя для каждой пары чат-пользователь."""
+    return os.path.join(STAGING_DIR, f"{key.chat_id}_{key.user_id}")
+
+
+def touch(key: StorageKey):
+    """Продлевает жизнь файлов диалога, пока пользователь в нём активен."""
+    try:
+        os.utime(user_dir(key))
+    except FileNotFoundError:
+        pass
+
+
+def staged_size(key: StorageKey) -> int:
+    path = user_dir(key)
+    if not os.path.isdir(path):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+
+async def stage_file(bot: Bot, key: StorageKey, file_info: dict) -> str:
+    async with _download_semaphore:
+        file = await bot.get_file(file_info['file_id'])
+        path = os.path.join(user_dir(key), uuid.uuid4().hex)
+        # aiogram пишет файл на диск по частям, целиком в памяти он не держится
+        await bot.download_file(file.file_path, destination=path)
+        return path
+
+
+async def stage_files(bot: Bot, key: StorageKey, uploads: List[dict]) -> Tuple[List[dict], List[str]]:
+    """Параллельно скачивает файлы из Telegram во временную папку диалога.
+
+    Возвращает лёгкие описатели {'path', 'filename'} для состояния FSM и имена
+    файлов, которые не попали в папку: сверх лимита пользователя или не
+    скачанных (например, больше 20 МБ, которые Telegram боту не отдаёт).
+    """
+    os.makedirs(user_dir(key), exist_ok=True)
+
+    budget = USER_LIMIT_BYTES - staged_size(key)
+    accepted = []
+    rejected = []
+    for file_info in uploads:
+        size = file_info.get('file_size') or 0
+        if size > budget:
+            logger.warning("Файл %s пользователя %s не помещается в лимит %s байт",
+                           file_info['filename'], key.user_id, USER_LIMIT_BYTES)
+            rejected.append(file_info['filename'])
+            continue
+        budget -= size
+        accepted.append(file_info)
+
+    results = await asyncio.gather(
+        *(stage_file(bot, key, file_info) for file_info in accepted), return_exceptions=True)
+
+    staged = []
+    for file_info, result in zip(accepted, results):
+        if isinstance(result, Exception):
+            logger.error("Не удалось скачать файл %s из Telegram: %s",
+                         file_info['filename'], result)
+            rejected.append(file_info['filename'])
+        else:
+            staged.append({'path': result, 'filename': file_info['filename']})
+    return staged, rejected
+
+
+async def cleanup_user(key: StorageKey):
+    await asyncio.to_thread(shutil.rmtree, user_dir(key), True)
+
+
+def remove_expired():
+    if not os.path.isdir(STAGING_DIR):
+        return
+    expire_before = time() - STAGING_TTL_SECONDS
+    for entry in os.scandir(STAGING_DIR):
+        if entry.is_dir() and entry.stat().st_mtime < expire_before:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            logger.info("Удалены брошенные файлы диалога %s", entry.name)
+
+
+class StagingTouchMiddleware(BaseMiddleware):
+    """Каждый апдейт диалога отодвигает удаление его файлов."""
+
+    async def __call__(self, handler, event, data):
+        state = data.get('state')
+        if state is not None:
+            touch(state.key)
+        return await handler(event, data)
+
+
+async def remove_expired_forever():
+    while True:
+        try:
+            await asyncio.to_thread(remove_expired)
+        except Exception as e:
+            logger.error("Ошибка при очистке временных файлов: %s", e)
+        await asyncio.sleep(STAGING_TTL_SECONDS / 4)
@@ -1,13 +1,16 @@
 #!/usr/bin/env python
 import sys
+import asyncio
 from os import getenv
+from time import monotonic, time
 import configparser
 import logging
-from typing import Tuple
+from typing import Dict, List, Tuple
 import redis
+from redis import asyncio as redis_asyncio
 from redis.exceptions import RedisError
-import mysql.connector
 from cryptography.fernet import Fernet
+from redmine_db import DATABASE_CONFIG, fetchall, fetchone, iterate
 
 logger = logging.getLogger(__name__)
 
@@ -20,20 +23,73 @@ REDIS_DB = int(config['Redis']['db'])
 REDIS_USER = config['Redis']['user']
 REDIS_PASS = getenv('REDIS_PASS')
 EXPIRE_TIME_SECONDS = int(config['Redis']['expire_time_seconds'])
-
-DATABASE_CONFIG = {
-    'host': config['Database']['host'],
-    'user': config['Database']['user'],
-    'database': config['Database']['database']
-}
+# Ключи используемых пользователей перепроверяются в базе и продлеваются заранее, до истечения
+REFRESH_AHEAD_SECONDS = config['Redis'].getint(
+    'refresh_ahead_seconds', fallback=3600)
+REFRESH_INTERVAL_SECONDS = config['Redis'].getint(
+    'refresh_interval_seconds', fallback=300)
+REFRESH_BATCH_SIZE = 500
+PRELOAD_ON_START = config['Redis'].getboolean(
+    'preload_api_keys_on_start', fallback=False)
+PRELOAD_BATCH_SIZE = 1000
 
 # id custom поля - TelegramLogin в Редмайн
 telegramCustomId = int(config['Redmine']['custom_id'])
 
+API_KEY_QUERY = """
+    SELECT t.value, u.id
+    FROM tokens AS t
+    JOIN users AS u ON t.user_id = u.id
+    JOIN custom_values AS cv ON u.id = cv.customized_id
+    WHERE cv.custom_field_id = %s
+    AND cv.value = %s
+    AND t.action = 'api';
+"""
+
+API_KEYS_BATCH_QUERY = """
+    SELECT cv.value, t.value, u.id
+    FROM tokens AS t
+    JOIN users AS u ON t.user_id = u.id
+    JOIN custom_values AS cv ON u.id = cv.customized_id
+    WHERE cv.custom_field_id = %s
+    AND cv.value IN ({placeholders})
+    AND t.action = 'api';
+"""
+
+# Все пользователи с Telegram логином и api ключом, для прогрева кэша
+ALL_API_KEYS_QUERY = """
+    SELECT cv.value, t.value, u.id
+    FROM tokens AS t
+    JOIN users AS u ON t.user_id = u.id
+    JOIN custom_values AS cv ON u.id = cv.customized_id
+    WHERE cv.custom_field_id = %s
+    AND cv.customized_type = 'Principal'
+    AND cv.value <> ''
+    AND t.action = 'api';
+"""
+
 # Создание подключения к Redis
 redis_conn = redis.StrictRedis(
     host=REDIS_HOST, port=REDIS_PORT, username=REDIS_USER, password=REDIS_PASS, db=REDIS_DB)
 
+# Асинхронное подключение для обработчиков бота и вебхуков
+async_redis_conn = redis_asyncio.StrictRedis(
+    host=REDIS_HOST, port=REDIS_PORT, username=REDIS_USER, password=REDIS_PASS, db=REDIS_DB,
+    decode_responses=True)
+
+# Ключ, под которым хранятся api ключ, id в Редмайне и chat_id пользователя
+USER_KEY_PREFIX = 'telegram_user'
+
+
+def user_key(telegram_username: str) -> str:
+    return f"{USER_KEY_PREFIX}:{telegram_username}"
+
+
+def legacy_keys(telegram_username: str) -> List[str]:
+    return [f"{telegram_username}_key",
+            f"{telegram_username}_id",
+            f"{telegram_username}_chat_id"]
+
 
 def save_fernet_key():
     """Генерация и сохранение ключа шифрования в Redis."""
@@ -79,63 +135,246 @@ def is_password_encrypted():
         return False
 
 
-def get_data_from_redis(telegram_username: str) -> Tuple[str, int, int]:
-    try:
-        api_key = redis_conn.get(f"{telegram_username}_key")
-        id_from_db = redis_conn.get(f"{telegram_username}_id")
-        chat_id_from_db = redis_conn.get(f"{telegram_username}_chat_id")
+async def migrate_legacy_keys(telegram_usernames: List[str]) -> Dict[str, Dict[str, str]]:
+    """Перенос старых ключей <login>_key/_id/_chat_id в хэши пользователей."""
+    async with async_redis_conn.pipeline(transaction=False) as pipe:
+        for login in telegram_usernames:
+            pipe.mget(legacy_keys(login))
+            pipe.ttl(f"{login}_key")
+        results = await pipe.execute()
 
-    except RedisError as e:
-        raise e
+    migrated = {}
+    for login, (api_key, id_from_db, chat_id), ttl in zip(telegram_usernames, results[::2], results[1::2]):
+        user_data = {}
+        if api_key and id_from_db:
+            user_data.update(key=api_key, id=id_from_db,
+                             expires_at=int(time()) + max(ttl, 0))
+        if chat_id:
+            user_data['chat_id'] = chat_id
+        if user_data:
+            migrated[login] = user_data
 
-    return (value.decode('utf-8') if value else None for value in (api_key, id_from_db, chat_id_from_db))
+    if migrated:
+        async with async_redis_conn.pipeline(transaction=True) as pipe:
+            for login, user_data in migrated.items():
+                pipe.hset(user_key(login), mapping=user_data)
+                pipe.delete(*legacy_keys(login))
+            await pipe.execute()
+        logger.info("Ключи пользователей %s перенесены в хэш",
+                    ', '.join(migrated))
 
+    return migrated
 
-def set_data_to_redis(telegram_username: str, api_key: str, id_from_db: int, chat_id: int):
-    redis_conn.set(f"{telegram_username}_key", api_key, ex=EXPIRE_TIME_SECONDS)
-    redis_conn.set(f"{telegram_username}_id",
-                   id_from_db, ex=EXPIRE_TIME_SECONDS)
-    redis_conn.set(f"{telegram_username}_chat_id",
-                   chat_id)
 
+def parse_user_data(user_data: Dict[str, str]) -> Tuple[str, str, str]:
+    """Разбор хэша пользователя. Просроченные ключ и id считаются отсутствующими."""
+    chat_id = user_data.get('chat_id')
+    if int(user_data.get('expires_at', 0)) <= time():
+        return None, None, chat_id
+    return user_data.get('key'), user_data.get('id'), chat_id
 
-def get_data_from_db(telegram_username: str) -> Tuple[str, int]:
-    cnx = mysql.connector.connect(**DATABASE_CONFIG)
-    cursor = cnx.cursor()
 
-    query = """
-        SELECT t.value, u.id
-        FROM tokens AS t
-        JOIN users AS u ON t.user_id = u.id
-        JOIN custom_values AS cv ON u.id = cv.customized_id
-        WHERE cv.custom_field_id = %s
-        AND cv.value = %s
-        AND t.action = 'api';
-    """
-    cursor.execute(query, (telegramCustomId, telegram_username))
-    result = cursor.fetchone()
-    cursor.close()
-    cnx.close()
+async def get_data_from_redis(telegram_username: str) -> Tuple[str, str, str]:
+    user_data = await async_redis_conn.hgetall(user_key(telegram_username))
+    if not user_data:
+        migrated = await migrate_legacy_keys([telegram_username])
+        user_data = migrated.get(telegram_username, {})
+
+    return parse_user_data(user_data)
+
+
+async def set_data_to_redis(telegram_username: str, api_key: str = None, id_from_db: int = None, chat_id: int = None):
+    user_data = {}
+    if api_key and id_from_db:
+        user_data.update(key=api_key, id=id_from_db,
+                         expires_at=int(time()) + EXPIRE_TIME_SECONDS)
+    if chat_id:
+        user_data['chat_id'] = chat_id
+
+    if user_data:
+        await async_redis_conn.hset(user_key(telegram_username), mapping=user_data)
+
+
+async def get_data_from_db(telegram_username: str) -> Tuple[str, int]:
+    result = await fetchone(API_KEY_QUERY, (telegramCustomId, telegram_username))
 
     return result if result else (None, None)
 
 
-def get_api_key_and_login_from_telegram(telegram_username: str, chat_id: int = None) -> Tuple[str, int, int]:
+async def get_api_key_and_login_from_telegram(telegram_username: str, chat_id: int = None) -> Tuple[str, str, str]:
+    api_key, id_from_db, chat_id_from_db = None, None, None
+    api_key_refresher.touch(telegram_username)
     try:
-        api_key, id_from_db, chat_id_from_db = get_data_from_redis(
+        api_key, id_from_db, chat_id_from_db = await get_data_from_redis(
             telegram_username)
 
-        if chat_id and (not chat_id_from_db or chat_id != chat_id_from_db):
-            redis_conn.set(f"{telegram_username}_chat_id",
-                           chat_id)
+        # chat_id обновляем, только если он изменился
+        new_chat_id = chat_id if chat_id and str(
+            chat_id) != chat_id_from_db else None
 
+        new_api_key, new_id = None, None
         if not api_key or not id_from_db:
-            api_key, id_from_db = get_data_from_db(telegram_username)
-            if api_key and id_from_db:
-                set_data_to_redis(telegram_username, api_key,
-                                  id_from_db, chat_id)
+            new_api_key, new_id = await get_data_from_db(telegram_username)
+            api_key, id_from_db = new_api_key, new_id
+
+        # Все изменения записываются одной командой
+        await set_data_to_redis(telegram_username, new_api_key,
+                                new_id, new_chat_id)
+        if new_chat_id:
+            chat_id_from_db = str(new_chat_id)
 
     except RedisError as e:
-        logger.error(f"Ошибка Redis: %s {e}")
+        logger.error("Ошибка Redis: %s", e)
 
     return api_key, id_from_db, chat_id_from_db
+
+
+async def get_data_from_db_batch(telegram_usernames: List[str]) -> Dict[str, Tuple[str, int]]:
+    """Api ключи и id пользователей одним запросом с cv.value IN (...)."""
+    if not telegram_usernames:
+        return {}
+
+    query = API_KEYS_BATCH_QUERY.format(
+        placeholders=', '.join(['%s'] * len(telegram_usernames)))
+    rows = await fetchall(query, (telegramCustomId, *telegram_usernames))
+
+    return {login: (api_key, id_from_db) for login, api_key, id_from_db in rows}
+
+
+async def get_api_keys_and_chat_ids(telegram_usernames: List[str]) -> Dict[str, Tuple[str, str, str]]:
+    """Пакетный вариант get_api_key_and_login_from_telegram для списка логинов.
+
+    Хэши всех пользователей читаются одним пайплайном, промахи добираются
+    из базы одним запросом и записываются обратно одним пайплайном.
+    """
+    logins = list(dict.fromkeys(telegram_usernames))
+    users = {login: (None, None, None) for login in logins}
+    for login in logins:
+        api_key_refresher.touch(login)
+    if not logins:
+        return users
+
+    try:
+        async with async_redis_conn.pipeline(transaction=False) as pipe:
+            for login in logins:
+                pipe.hgetall(user_key(login))
+            results = await pipe.execute()
+
+        users_data = dict(zip(logins, results))
+        not_found = [login for login, data in users_data.items() if not data]
+        if not_found:
+            users_data.update(await migrate_legacy_keys(not_found))
+
+        users = {login: parse_user_data(data)
+                 for login, data in users_data.items()}
+
+        misses = [login for login, (api_key, id_from_db, _) in users.items()
+                  if not api_key or not id_from_db]
+        from_db = await get_data_from_db_batch(misses)
+
+        if from_db:
+            expires_at = int(time()) + EXPIRE_TIME_SECONDS
+            async with async_redis_conn.pipeline(transaction=False) as pipe:
+                for login, (api_key, id_from_db) in from_db.items():
+                    pipe.hset(user_key(login), mapping={
+                        'key': api_key, 'id': id_from_db, 'expires_at': expires_at})
+                    users[login] = (api_key, id_from_db, users[login][2])
+                await pipe.execute()
+
+    except RedisError as e:
+        logger.error("Ошибка Redis: %s", e)
+
+    return users
+
+
+async def preload_api_keys() -> int:
+    """Загружает в Redis api ключи всех пользователей с Telegram логином.
+
+    Строки читаются из базы потоком, каждая пачка записывается одним пайплайном.
+    Возвращает число загруженных пользователей.
+    """
+    expires_at = int(time()) + EXPIRE_TIME_SECONDS
+    total = 0
+    async for rows in iterate(ALL_API_KEYS_QUERY, (telegramCustomId,), PRELOAD_BATCH_SIZE):
+        async with async_redis_conn.pipeline(transaction=False) as pipe:
+            for login, api_key, id_from_db in rows:
+                pipe.hset(user_key(login), mapping={
+                    'key': api_key, 'id': id_from_db, 'expires_at': expires_at})
+            await pipe.execute()
+        total += len(rows)
+
+    logger.info("В кэш загружены api ключи %s пользователей", total)
+    return total
+
+
+class ApiKeyRefresher:
+    """Продление api ключей используемых пользователей до истечения.
+
+    Логины, к которым обращались за последние EXPIRE_TIME_SECONDS, раз в
+    refresh_interval проверяются пачками: ключи, которым осталось меньше
+    refresh_ahead секунд, перечитываются из базы одним запросом на пачку и
+    продлеваются, а отозванные (в базе ключа больше нет) удаляются из кэша.
+    """
+
+    def __init__(self, refresh_interval: int, refresh_ahead: int):
+        self.refresh_interval = refresh_interval
+        self.refresh_ahead = refresh_ahead
+        self._last_used: Dict[str, float] = {}
+        self._task = None
+
+    def touch(self, telegram_username: str):
+        self._last_used[telegram_username] = monotonic()
+
+    def _active_logins(self) -> List[str]:
+        used_after = monotonic() - EXPIRE_TIME_SECONDS
+        self._last_used = {login: used_at for login, used_at in self._last_used.items()
+                           if used_at > used_after}
+        return list(self._last_used)
+
+    async def refresh_batch(self, logins: List[str]):
+        async with async_redis_conn.pipeline(transaction=False) as pipe:
+            for login in logins:
+                pipe.hget(user_key(login), 'expires_at')
+            expires = await pipe.execute()
+
+        refresh_before = time() + self.refresh_ahead
+        expiring = [login for login, expires_at in zip(logins, expires)
+                    if expires_at and int(expires_at) <= refresh_before]
+        if not expiring:
+            return
+
+        from_db = await get_data_from_db_batch(expiring)
+        expires_at = int(time()) + EXPIRE_TIME_SECONDS
+        revoked = [login for login in expiring if login not in from_db]
+        async with async_redis_conn.pipeline(transaction=False) as pipe:
+            for login, (api_key, id_from_db) in from_db.items():
+                pipe.hset(user_key(login), mapping={
+                    'key': api_key, 'id': id_from_db, 'expires_at': expires_at})
+            for login in revoked:
+                # chat_id остаётся, он нужен для уведомлений
+                pipe.hdel(user_key(login), 'key', 'id', 'expires_at')
+            await pipe.execute()
+
+        if revoked:
+            logger.info("Api ключи пользователей %s отозваны",
+                        ', '.join(revoked))
+
+    async def refresh(self):
+        logins = self._active_logins()
+        for start in range(0, len(logins), REFRESH_BATCH_SIZE):
+            await self.refresh_batch(logins[start:start + REFRESH_BATCH_SIZE])
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error("Не удалось продлить api ключи: %s", e)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_forever())
+
+
+api_key_refresher = ApiKeyRefresher(REFRESH_INTERVAL_SECONDS, REFRESH_AHEAD_SECONDS)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+import configparser
+import logging
+from collections import OrderedDict
+from time import monotonic
+from typing import Dict, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# Сколько секунд запись отдаётся без обращения к Редмайну
+ISSUE_CACHE_SECONDS = config['Redmine'].getint(
+    'issue_cache_seconds', fallback=60)
+ISSUE_CACHE_SIZE = config['Redmine'].getint('issue_cache_size', fallback=1000)
+
+
+class IssueCacheEntry:
+    __slots__ = ('issue', 'rendered', 'updated_on', 'checked_at')
+
+    def __init__(self, issue: dict, rendered: str):
+        self.issue = issue
+        self.rendered = rendered
+        self.updated_on = issue.get('updated_on')
+        self.checked_at = monotonic()
+
+    @property
+    def fresh(self) -> bool:
+        return monotonic() - self.checked_at < ISSUE_CACHE_SECONDS
+
+    def touch(self):
+        self.checked_at = monotonic()
+
+
+class IssueCache:
+    """LRU кэш задач с уже отрисованным ответом.
+
+    Ключ - номер задачи и id пользователя: набор видимых полей и приватных
+    комментариев зависит от его ролей в проекте.
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Tuple[str, str], IssueCacheEntry]' = OrderedDict()
+        self._scopes: Dict[str, Set[str]] = {}
+
+    def get(self, issue_id, scope) -> Optional[IssueCacheEntry]:
+        key = (str(issue_id), str(scope))
+        entry = self._entries.get(key)
+        if entry:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, issue_id, scope, issue: dict, rendered: str):
+        key = (str(issue_id), str(scope))
+        self._entries[key] = IssueCacheEntry(issue, rendered)
+        self._entries.move_to_end(key)
+        self._scopes.setdefault(key[0], set()).add(key[1])
+
+        while len(self._entries) > self.max_entries:
+            (old_issue_id, old_scope), _ = self._entries.popitem(last=False)
+            self._discard_scope(old_issue_id, old_scope)
+
+    def invalidate(self, issue_id):
+        """Сбрасывает задачу для всех пользователей (пришло изменение из вебхука)."""
+        issue_id = str(issue_id)
+        for scope in self._scopes.pop(issue_id, ()):
+            self._entries.pop((issue_id, scope), None)
+
+    def _discard_scope(self, issue_id: str, scope: str):
+        scopes = self._scopes.get(issue_id)
+        if scopes:
+            scopes.discard(scope)
+            if not scopes:
+                del self._scopes[issue_id]
+
+
+issue_cache = IssueCache(ISSUE_CACHE_SIZE)
@@ -8,7 +8,14 @@ import asyncio
 from my_logger import setup_logger
 import redmine_bot
 import web_hooks
+from redmine_client import redmine_client
+from redmine_db import close_pool
+import redmine_writer
+from telegram_bot import bot
 from get_api_key import (
+    PRELOAD_ON_START,
+    async_redis_conn,
+    preload_api_keys,
     save_fernet_key,
     cipher_password,
     decrypt_password,
@@ -20,12 +27,43 @@ setup_logger()
 logger = logging.getLogger(__name__)
 
 
+async def close_connections():
+    await redmine_client.close()
+    await async_redis_conn.aclose()
+    await close_pool()
+    redmine_writer.shutdown()
+    await bot.session.close()
+
+
+async def preload():
+    """Отдельная команда для пересинхронизации кэша ключей по расписанию: python main.py preload_api_keys"""
+    try:
+        await preload_api_keys()
+    finally:
+        await close_connections()
+
+
 async def main():
-    # Запускаем обе асинхронные функции параллельно
-    await asyncio.gather(
-        redmine_bot.main(),
-        web_hooks.main()
-    )
+    try:
+        # Реплика начинает принимать апдейты уже с прогретым кэшем ключей
+        if PRELOAD_ON_START:
+            try:
+                await preload_api_keys()
+            except Exception as e:
+                logger.error("Не удалось прогреть кэш api ключей: %s", e)
+
+        if redmine_bot.UPDATE_MODE == 'webhook':
+            # Апдейты Telegram принимает тот же сервер, что и вебхуки Редмайна
+            await redmine_bot.start_webhook(web_hooks.app)
+            await web_hooks.main()
+        else:
+            # Запускаем обе асинхронные функции параллельно
+            await asyncio.gather(
+                redmine_bot.main(),
+                web_hooks.main()
+            )
+    finally:
+        await close_connections()
 
 if __name__ == "__main__":
     config = configparser.ConfigParser()
@@ -53,4 +91,7 @@ if __name__ == "__main__":
         logger.error("Не удалось подключиться к Redis: %s", e)
         sys.exit(1)
 
-    asyncio.run(main())
+    if sys.argv[1:] == ['preload_api_keys']:
+        asyncio.run(preload())
+    else:
+        asyncio.run(main())
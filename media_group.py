@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+from time import monotonic, time
+from typing import Awaitable, Callable, Dict, List, Tuple
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseEventIsolation
+from aiogram.fsm.storage.memory import DisabledEventIsolation
+from aiogram.types import Message
+from redis.asyncio import Redis
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# Сколько ждать следующее сообщение альбома, прежде чем считать его полученным целиком
+MEDIA_GROUP_SETTLE_SECONDS = config.getfloat(
+    'Telegram', 'media_group_settle_seconds', fallback=1.0)
+
+# Сколько живёт общий буфер альбома, если все реплики упали, не дождавшись его
+SHARED_BUFFER_TTL_SECONDS = 60
+
+Key = Tuple[int, str]
+
+
+class PendingMediaGroup:
+    def __init__(self, state: FSMContext, bot: Bot):
+        self.state = state
+        self.bot = bot
+        self.messages: List[Message] = []
+        self.last_seen = monotonic()
+
+
+class MediaGroupAggregator:
+    """Собирает сообщения одного альбома (media_group_id) и отдаёт их разом.
+
+    Telegram присылает каждый файл альбома отдельным сообщением. Альбом
+    считается полученным, когда за settle секунд не пришло ни одного нового
+    сообщения, после этого commit вызывается один раз со всеми сообщениями.
+
+    commit выполняется вне обработки апдейта, поэтому берёт ту же блокировку
+    isolation, что и диспетчер, и не перетирает состояние параллельного апдейта.
+    """
+
+    def __init__(self, settle: float, commit: Callable[[List[Message], FSMContext], Awaitable[None]]):
+        self.settle = settle
+        self.commit = commit
+        # Диспетчер подставляет свою при запуске
+        self.isolation: BaseEventIsolation = DisabledEventIsolation()
+        self._pending: Dict[Key, PendingMediaGroup] = {}
+        self._tasks = set()
+
+    async def add(self, message: Message, state: FSMContext):
+        key = (message.chat.id, message.media_group_id)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = PendingMediaGroup(state, message.bot)
+            task = asyncio.create_task(self._flush_when_settled(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        await self._push(key, pending, message)
+
+    async def _push(self, key: Key, pending: PendingMediaGroup, message: Message):
+        pending.messages.append(message)
+        pending.last_seen = monotonic()
+
+    async def _settle_delay(self, key: Key, pending: PendingMediaGroup) -> float:
+        return pending.last_seen + self.settle - monotonic()
+
+    async def _take(self, key: Key, pending: PendingMediaGroup) -> List[Message]:
+        return pending.messages
+
+    async def _flush_when_settled(self, key: Key):
+        pending = self._pending[key]
+        try:
+            delay = self.settle
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = await self._settle_delay(key, pending)
+
+            del self._pending[key]
+            async with self.isolation.lock(pending.state.key):
+                messages = await self._take(key, pending)
+                if not messages:
+                    # Альбом уже забрала другая реплика
+                    return
+                # Telegram не гарантирует порядок доставки сообщений альбома
+                messages.sort(key=lambda message: message.message_id)
+                await self.commit(messages, pending.state)
+        except Exception as e:
+            if self._pending.get(key) is pending:
+                del self._pending[key]
+            logger.error("Не удалось обработать альбом %s: %s", key[1], e)
+
+
+class SharedMediaGroupAggregator(MediaGroupAggregator):
+    """Копит альбом в Redis: при вебхуках сообщения одного альбома приходят на разные реплики.
+
+    Таймер заводит каждая реплика, получившая часть альбома, но сообщения
+    забирает из Redis только первая, остальные находят буфер пустым.
+    """
+
+    def __init__(self, redis: Redis, settle: float,
+                 commit: Callable[[List[Message], FSMContext], Awaitable[None]]):
+        super().__init__(settle, commit)
+        self.redis = redis
+
+    @staticmethod
+    def _redis_key(key: Key) -> str:
+        return f"telegram_album:{key[0]}:{key[1]}"
+
+    async def _push(self, key: Key, pending: PendingMediaGroup, message: Message):
+        redis_key = self._redis_key(key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(redis_key, message.model_dump_json(
+                by_alias=True, exclude_none=True))
+            pipe.expire(redis_key, SHARED_BUFFER_TTL_SECONDS)
+            # Часы реплик сравнимы только по времени эпохи, monotonic у каждой свой
+            pipe.set(redis_key + ':last_seen', time(), ex=SHARED_BUFFER_TTL_SECONDS)
+            await pipe.execute()
+
+    async def _settle_delay(self, key: Key, pending: PendingMediaGroup) -> float:
+        last_seen = await self.redis.get(self._redis_key(key) + ':last_seen')
+        if last_seen is None:
+            return 0
+        return float(last_seen) + self.settle - time()
+
+    async def _take(self, key: Key, pending: PendingMediaGroup) -> List[Message]:
+        redis_key = self._redis_key(key)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.lrange(redis_key, 0, -1)
+            pipe.delete(redis_key, redis_key + ':last_seen')
+            raw_messages, _ = await pipe.execute()
+        return [Message.model_validate_json(raw, context={'bot': pending.bot})
+                for raw in raw_messages]
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+from time import monotonic
+from typing import Dict, List, Optional
+from redmine_db import fetchall
+from redmine_writer import get_redmine, run_sync
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+REFRESH_SECONDS = config['Database'].getint(
+    'membership_refresh_seconds', fallback=300)
+FULL_REFRESH_SECONDS = config['Database'].getint(
+    'membership_full_refresh_seconds', fallback=3600)
+
+# id custom поля - TelegramLogin в Редмайн
+telegramCustomId = int(config['Redmine']['custom_id'])
+
+# Проекты всех пользователей с Telegram логином. Архивные (9) и удаляемые (10)
+# проекты REST API в членствах не показывает, поэтому и здесь их нет.
+MEMBERSHIPS_QUERY = """
+    SELECT m.id, m.user_id, p.id, p.name
+    FROM members AS m
+    JOIN projects AS p ON p.id = m.project_id
+    JOIN custom_values AS cv ON cv.customized_id = m.user_id
+    WHERE cv.custom_field_id = %s
+    AND cv.customized_type = 'Principal'
+    AND cv.value <> ''
+    AND p.status IN (1, 5)
+    AND m.id > %s
+    ORDER BY m.id;
+"""
+
+
+class MembershipIndex:
+    """Индекс user_id -> проекты пользователя, загружаемый из базы Редмайна одним запросом.
+
+    Раз в REFRESH_SECONDS догружаются только новые членства (members.id больше
+    последнего виденного), раз в FULL_REFRESH_SECONDS индекс строится заново,
+    чтобы из него пропали удалённые членства и архивные проекты.
+    """
+
+    def __init__(self, refresh_seconds: int, full_refresh_seconds: int):
+        self.refresh_seconds = refresh_seconds
+        self.full_refresh_seconds = full_refresh_seconds
+        self._projects: Dict[int, List[dict]] = {}
+        self._last_member_id = 0
+        self._full_refresh_at = 0
+        self._loaded = False
+        self._task = None
+
+    async def refresh(self, full: bool = False):
+        last_member_id = 0 if full else self._last_member_id
+        rows = await fetchall(MEMBERSHIPS_QUERY, (telegramCustomId, last_member_id))
+
+        projects = {} if full else self._projects
+        for member_id, user_id, project_id, project_name in rows:
+            projects.setdefault(user_id, []).append(
+                {"id": project_id, "name": project_name})
+            last_member_id = max(last_member_id, member_id)
+
+        self._projects = projects
+        self._last_member_id = last_member_id
+        if full:
+            self._full_refresh_at = monotonic()
+            logger.info("Индекс членств загружен: %s пользователей",
+                        len(projects))
+        self._loaded = True
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            full = monotonic() - self._full_refresh_at >= self.full_refresh_seconds
+            try:
+                await self.refresh(full=full)
+            except Exception as e:
+                logger.error("Не удалось обновить индекс членств: %s", e)
+
+    async def start(self):
+        try:
+            await self.refresh(full=True)
+        except Exception as e:
+            logger.error("Не удалось загрузить индекс членств: %s", e)
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_forever())
+
+    def get(self, user_id) -> Optional[List[dict]]:
+        """Проекты пользователя или None, если индекс о нём ничего не знает."""
+        if not self._loaded:
+            return None
+        return self._projects.get(int(user_id))
+
+
+membership_index = MembershipIndex(REFRESH_SECONDS, FULL_REFRESH_SECONDS)
+
+
+async def get_user_projects(api_key: str, user_id) -> List[dict]:
+    """Проекты пользователя из индекса, а для неизвестных индексу - через REST API."""
+    projects = membership_index.get(user_id)
+    if projects is not None:
+        return projects
+
+    # Клиент берётся в event loop: кэш клиентов не рассчитан на доступ из потоков
+    redmine = get_redmine(api_key)
+
+    def load_memberships():
+        memberships = redmine.user.get(user_id).memberships
+        return [{"id": membership.project.id,
+                 "name": membership.project.name} for membership in memberships]
+
+    return await run_sync(load_memberships)
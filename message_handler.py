@@ -3,6 +3,16 @@ import html
 
 
 def message_handler(data: dict) -> str:
+    header, message_parts, attachment_id, attachment_names = parse_message(data)
+    return render_message(header, message_parts), attachment_id, attachment_names
+
+
+def render_message(header: str, message_parts: list) -> str:
+    return "\n\n".join([header, *message_parts])
+
+
+def parse_message(data: dict) -> tuple:
+    """Заголовок [проект - #id] тема и части сообщения (изменения, комментарии) отдельно."""
     issue_id = data['data']['issue']['id']
     project_name = data['data']['issue']['project']['name']
     subject = data['data']['issue']['subject']
@@ -12,7 +22,7 @@ def message_handler(data: dict) -> str:
     attachment_id = []
     attachment_names = []
 
-    message_parts.append(f"[{project_name} - #{issue_id}] {subject}")
+    header = f"[{project_name} - #{issue_id}] {subject}"
 
     for change in changes:
         user_name = change['user']['name']
@@ -36,7 +46,7 @@ def message_handler(data: dict) -> str:
             message_parts.append(
                 f"<strong>{user_name} писал(а)</strong>:\n---\n{notes}")
 
-    return "\n\n".join(message_parts), attachment_id, attachment_names
+    return header, message_parts, attachment_id, attachment_names
 
 
 def handle_status(detail) -> str:
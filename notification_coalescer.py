@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+from typing import Awaitable, Callable, Dict, List, Tuple
+from message_handler import render_message
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# 0 - окно выключено, каждое изменение отправляется сразу
+COALESCE_WINDOW_SECONDS = config.getfloat(
+    'Webhooks', 'coalesce_window_seconds', fallback=0)
+
+
+class PendingNotification:
+    def __init__(self, header: str):
+        self.header = header
+        self.parts: List[str] = []
+        self.attachments = []
+        # Завершается после отправки, по нему подтверждаются записи очереди вебхуков
+        self.sent = asyncio.get_running_loop().create_future()
+
+    def render(self) -> str:
+        return render_message(self.header, self.parts)
+
+
+class NotificationCoalescer:
+    """Склеивает изменения одной задачи для одного получателя, пришедшие за окно.
+
+    Окно отсчитывается от первого изменения, поэтому задержка уведомления
+    не больше window секунд даже при непрерывном потоке правок.
+    """
+
+    def __init__(self, window: float, deliver: Callable[[str, str, list], Awaitable[None]]):
+        self.window = window
+        self.deliver = deliver
+        self._pending: Dict[Tuple[str, str], PendingNotification] = {}
+        self._tasks = set()
+
+    def add(self, issue_id, chat_id, header: str, parts: List[str], attachments: list) -> asyncio.Future:
+        """Добавляет изменение в ожидающее уведомление. Возвращает future его отправки."""
+        key = (str(issue_id), str(chat_id))
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = self._pending[key] = PendingNotification(header)
+            task = asyncio.create_task(self._flush_later(key))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+        # Тема могла поменяться, в заголовке показываем последнюю
+        pending.header = header
+        pending.parts.extend(parts)
+        for attachment in attachments:
+            attachment.retain()
+            pending.attachments.append(attachment)
+        return pending.sent
+
+    async def _flush_later(self, key: Tuple[str, str]):
+        await asyncio.sleep(self.window)
+        pending = self._pending.pop(key)
+        _, chat_id = key
+        try:
+            await self.deliver(chat_id, pending.render(), pending.attachments)
+        except Exception as e:
+            logger.error("Не удалось отправить уведомление в чат %s: %s",
+                         chat_id, e)
+        finally:
+            for attachment in pending.attachments:
+                attachment.release()
+            pending.sent.set_result(None)
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
+import asyncio
+import html
 import configparser
 import logging
-from redminelib import Redmine
 from redminelib.exceptions import ValidationError
 from get_api_key import get_api_key_and_login_from_telegram
+from issue_cache import issue_cache
+from membership_index import get_user_projects
+from redmine_resilience import RedmineUnavailable
+from redmine_writer import get_redmine, run_sync, upload_files
 
 logger = logging.getLogger(__name__)
 
@@ -18,9 +23,19 @@ PRIO_MAPPING = {
 }
 
 
-async def create_task(login: str, chat_id: int, subject: str, description: str, priority: str = "Обязательно", project: int = None, tracker_id: int = None, downloads=None):
+def skipped_files_note(skipped, rejected=None) -> str:
+    note = ""
+    if rejected:
+        note += (f"\nНе прикреплены файлы, которые не удалось получить из Telegram или которые "
+                 f"не поместились в лимит: {html.escape(', '.join(rejected))}.")
+    if skipped:
+        note += f"\nНе прикреплены пустые или устаревшие файлы: {html.escape(', '.join(skipped))}. Отправьте их ещё раз."
+    return note
+
+
+async def create_task(login: str, chat_id: int, subject: str, description: str, priority: str = "Обязательно", project: int = None, tracker_id: int = None, downloads=None, rejected_files=None):
     try:
-        api_key, user_id, _ = get_api_key_and_login_from_telegram(
+        api_key, user_id, _ = await get_api_key_and_login_from_telegram(
             login, chat_id)
 
         if not user_id:
@@ -29,16 +44,16 @@ async def create_task(login: str, chat_id: int, subject: str, description: str,
             return f"Пользователь с именем {login} не найден в Redmine."
 
         try:
-            redmine = Redmine(REDMINE_URL, key=api_key)
+            redmine = get_redmine(api_key)
         except Exception as e:
             logger.error(f"Ошибка при запросе к Redmine. Причина: %s {e}")
             return "Сервер Редмайн не доступен. Обратитесь к вашему админу."
 
-        # Получаем членства пользователя
-        memberships = redmine.user.get(user_id).memberships
+        # Получаем проекты пользователя
+        projects = await get_user_projects(api_key, user_id)
 
         # Если у пользователя нет членства в каких-либо проектах
-        if not memberships:
+        if not projects:
             logger.info(
                 f"У пользователя %s {login} нет доступа ни к одному проекту.")
             return f"У пользователя {login} нет доступа ни к одному проекту."
@@ -47,11 +62,19 @@ async def create_task(login: str, chat_id: int, subject: str, description: str,
 
         # Выбираем первый проект, в который входит пользователь
         if not project:
-            chosen_project = memberships[0].project
-            chosen_project_name = chosen_project.name
-            project = chosen_project.id
+            chosen_project = projects[0]
+            chosen_project_name = chosen_project['name']
+            project = chosen_project['id']
         else:
-            chosen_project_name = redmine.project.get(project).name
+            chosen_project_name = next(
+                (item['name'] for item in projects if item['id'] == project), None)
+
+        # Файлы загружаются параллельно, вместе с запросом имени проекта, если его нет в индексе
+        project_name_request = run_sync(redmine.project.get, project) if not chosen_project_name else asyncio.sleep(0)
+        uploads_request = upload_files(redmine, downloads) if downloads else asyncio.sleep(0, ([], []))
+        project_resource, (uploads, skipped) = await asyncio.gather(project_name_request, uploads_request)
+        if project_resource:
+            chosen_project_name = project_resource.name
 
         issue = redmine.issue.new()
         issue.project_id = project
@@ -60,14 +83,14 @@ async def create_task(login: str, chat_id: int, subject: str, description: str,
         issue.priority_id = prio_id
         issue.tracker_id = tracker_id
         # Если предоставлены файлы, добавляем их как вложения
-        if downloads:
-            # print(downloads)
-            issue.uploads = downloads
-        issue.save()
+        if uploads:
+            issue.uploads = uploads
+        await run_sync(issue.save)
 
         if hasattr(issue, 'id'):
             issue_url = f"{REDMINE_URL}/issues/{issue.id}"
             message = f'Задача <a href="{issue_url}">[{chosen_project_name} - #{issue.id}] {issue.subject}</a> создана!'
+            message += skipped_files_note(skipped, rejected_files)
             # print(message)
             return message
         else:
@@ -76,11 +99,15 @@ async def create_task(login: str, chat_id: int, subject: str, description: str,
     except ValidationError as e:
         logger.error(f"Произошла ошибка при создании задачи: %s {e}")
         return str(e)
+    except RedmineUnavailable as e:
+        logger.error(f"Ошибка при запросе к Redmine. Причина: %s {e}")
+        return "Сервер Редмайн не доступен. Обратитесь к вашему админу."
 
 
-async def add_comment_with_attachment(login: str, chat_id: int, task_number: int, comment: str, files=None):
+async def add_comment_with_attachment(login: str, chat_id: int, task_number: int, comment: str, files=None,
+                                      rejected_files=None):
     try:
-        api_key, user_id, _ = get_api_key_and_login_from_telegram(
+        api_key, user_id, _ = await get_api_key_and_login_from_telegram(
             login, chat_id)
 
         if not user_id:
@@ -89,25 +116,31 @@ async def add_comment_with_attachment(login: str, chat_id: int, task_number: int
             return f"Пользователь с именем {login} не найден в Redmine."
 
         try:
-            redmine = Redmine(REDMINE_URL, key=api_key)
+            redmine = get_redmine(api_key)
         except Exception as e:
             logger.error(f"Ошибка при запросе к Redmine. Причина: %s {e}")
             return "Сервер Редмайн не доступен. Обратитесь к вашему админу."
 
-        # Проверяем существование задачи
-        issue = redmine.issue.get(task_number)
+        # Проверяем существование задачи, параллельно загружая файлы
+        issue, (uploads, skipped) = await asyncio.gather(
+            run_sync(redmine.issue.get, task_number),
+            upload_files(redmine, files) if files else asyncio.sleep(0, ([], [])))
         if not issue:
             logger.info(f"Задача с номером %s {task_number} не найдена.")
             return f"Задача с номером {task_number} не найдена."
 
         # Добавляем комментарий с прикрепленными файлами
         issue.notes = comment
-        if files:
-            issue.uploads = files
-        issue.save()
+        if uploads:
+            issue.uploads = uploads
+        await run_sync(issue.save)
+        issue_cache.invalidate(task_number)
 
-        return f"Комментарий к задаче #{task_number} добавлен."
+        return f"Комментарий к задаче #{task_number} добавлен." + skipped_files_note(skipped, rejected_files)
 
     except ValidationError as e:
         logger.error(f"Произошла ошибка при добавлении комментария: %s {e}")
         return str(e)
+    except RedmineUnavailable as e:
+        logger.error(f"Ошибка при запросе к Redmine. Причина: %s {e}")
+        return "Сервер Редмайн не доступен. Обратитесь к вашему админу."
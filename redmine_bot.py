@@ -1,15 +1,20 @@
 #!/usr/bin/env python
 import re
+import asyncio
+import configparser
+import json
+from functools import partial
 from os import getenv
 import logging
-from typing import Optional
-from aiogram import Bot, Dispatcher, F, Router, types, html
-from aiogram.enums import ParseMode
+from typing import List, Optional
+from aiohttp import web
+from aiogram import Dispatcher, F, Router, types, html
 from aiogram.filters import Command, CommandStart
-from aiogram.exceptions import TelegramNotFound, TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
 from aiogram.methods import DeleteWebhook
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from aiogram.types import (
     KeyboardButton,
     Message,
@@ -19,9 +24,16 @@ from aiogram.types import (
     InlineKeyboardButton
 )
 from custom_filters import DocumentFilter, LongTextFilter
-from redmine_req import RedmineRequests
+from redmine_req import RedmineRequests, render_issue_list
 from redmine_api import create_task, add_comment_with_attachment
 from selectors_by_key import get_data_by_key
+from reference_data import reference_data
+from membership_index import membership_index
+from media_group import MEDIA_GROUP_SETTLE_SECONDS, MediaGroupAggregator, SharedMediaGroupAggregator
+from get_api_key import api_key_refresher, async_redis_conn, get_api_key_and_login_from_telegram
+from dialog_messages import DialogMessagesMiddleware, SentMessagesMiddleware, delete_messages
+from telegram_bot import bot
+from file_staging import StagingTouchMiddleware, cleanup_user, remove_expired_forever, stage_files
 
 logger = logging.getLogger(__name__)
 
@@ -46,12 +58,34 @@ priority_kb = ReplyKeyboardMarkup(
     resize_keyboard=True,
 )
 
-BOT_TOKEN = getenv("BOT_TOKEN")
+config = configparser.ConfigParser()
+config.read('config.ini')
+# memory - состояние диалогов в памяти процесса, redis - в Redis
+FSM_STORAGE = config.get('Telegram', 'fsm_storage', fallback='memory')
+FSM_STATE_TTL_SECONDS = config.getint(
+    'Telegram', 'fsm_state_ttl_seconds', fallback=86400)
+# polling - бот сам забирает апдейты, webhook - Telegram присылает их на сервер вебхуков
+UPDATE_MODE = config.get('Telegram', 'update_mode', fallback='polling')
+WEBHOOK_URL = config.get('Telegram', 'webhook_url', fallback='')
+WEBHOOK_PATH = config.get('Telegram', 'webhook_path', fallback='/telegram')
+TELEGRAM_SECRET_TOKEN = getenv("TELEGRAM_SECRET_TOKEN")
+
+background_tasks = set()
 
 form_router = Router()
 redmine_req = RedmineRequests()
 
-bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
+bot.session.middleware(SentMessagesMiddleware())
+form_router.message.outer_middleware(DialogMessagesMiddleware())
+form_router.callback_query.outer_middleware(DialogMessagesMiddleware())
+form_router.message.outer_middleware(StagingTouchMiddleware())
+form_router.callback_query.outer_middleware(StagingTouchMiddleware())
+
+# В состоянии диалога хранится имя операции, а не сама функция, чтобы его можно было сохранить в Redis
+OPERATIONS = {
+    'add_comment': add_comment_with_attachment,
+    'show_task': redmine_req.show_task,
+}
 
 
 class Form(StatesGroup):
@@ -80,41 +114,68 @@ class Form(StatesGroup):
 
 @form_router.message(DocumentFilter())
 async def process_files_from_message(message: Message, state: FSMContext = None) -> None:
+    # Файлы альбома приходят отдельными сообщениями, копим их и обрабатываем разом
+    if message.media_group_id:
+        await media_groups.add(message, state)
+        return
+    await commit_files([message], state)
+
+
+async def commit_files(messages: List[Message], state: FSMContext) -> None:
     # Получите текущие загрузки из состояния
     data = await state.get_data()
     current_uploads = data.get('uploads', [])
 
     # Если сообщение содержит документ
-    if message.document:
-        file_info = {'file_id': message.document.file_id,
-                     'filename': message.document.file_name}
-        current_uploads.append(file_info)
+    for message in messages:
+        if message.document:
+            file_info = {'file_id': message.document.file_id,
+                         'filename': message.document.file_name,
+                         'file_size': message.document.file_size}
+            current_uploads.append(file_info)
 
     data = {
         'uploads': current_uploads,
-        'number_of_files': len(current_uploads)
+        'number_of_files': len(data.get('downloads', [])) + len(current_uploads)
     }
     await state.update_data(**data)
 
+    # Подпись у альбома одна, обычно у первого сообщения
+    message = next((message for message in messages if message.caption), None)
+    if message is None or not current_uploads:
+        return
+
     # Если у сообщения есть подпись и загрузки
-    if message.reply_to_message and message.caption and current_uploads:
+    if message.reply_to_message:
         await handle_replies(message, state)
-    elif message.caption and current_uploads:
+    else:
         await process_long_text(message, state)
 
 
+if FSM_STORAGE == 'redis':
+    # Сообщения одного альбома могут прийти на разные реплики бота
+    media_groups = SharedMediaGroupAggregator(
+        async_redis_conn, MEDIA_GROUP_SETTLE_SECONDS, commit_files)
+else:
+    media_groups = MediaGroupAggregator(MEDIA_GROUP_SETTLE_SECONDS, commit_files)
+
+
 async def process_download_files(state: FSMContext) -> None:
     data = await state.get_data()
     current_downloads = data.get('downloads', [])
-    for file_info in data['uploads']:
-        file_id = file_info['file_id']
-        file = await bot.get_file(file_id)
-        file_path = file.file_path
-        file_stream = await bot.download_file(file_path)
-        file_info = {'path': file_stream,
-                     'filename': file_info['filename']}
-        current_downloads.append(file_info)
-    await state.update_data(downloads=current_downloads, uploads=[])
+    rejected_files = data.get('rejected_files', [])
+    # Файлы скачиваются параллельно во временную папку, в состоянии остаются только пути
+    staged, rejected = await stage_files(bot, state.key, data['uploads'])
+    current_downloads += staged
+    rejected_files += rejected
+    # Не скачанные файлы не считаются, о них пользователь узнает в ответе на задачу или комментарий
+    await state.update_data(downloads=current_downloads, uploads=[], rejected_files=rejected_files,
+                            number_of_files=len(current_downloads))
+
+
+async def clear_state(state: FSMContext) -> None:
+    await state.clear()
+    await cleanup_user(state.key)
 
 
 def get_keyboard(buttons_data: dict, buttons_order: Optional[list[list[str]]] = None) -> InlineKeyboardMarkup:
@@ -167,31 +228,15 @@ async def remove_keyboard(query: types.CallbackQuery):
     await bot.edit_message_text(text=query.message.text, chat_id=query.message.chat.id, message_id=query.message.message_id)
 
 
-async def delete_messages_until(message: Message, target_id: int, exclude_ids: set = None):
-    current_id = message.message_id
-
-    logger.info(
-        f"Начало удаления сообщений до %s {target_id} исключая {exclude_ids}")
-
-    # Удаление сообщений в обратном порядке, от более новых к старым.
-    while current_id > target_id:
-        if current_id in exclude_ids:
-            current_id -= 1
-            continue
+async def delete_messages_until(message: Message, data: dict, exclude_ids: set = None):
+    """Удаляет сообщения диалога, появившиеся после формы задачи, и само сообщение message."""
+    exclude_ids = set(exclude_ids or ())
+    message_ids = [message_id for message_id in data.get('dialog_message_ids', []) + [message.message_id]
+                   if message_id > data['message_id'] and message_id not in exclude_ids]
 
-        try:
-            await bot.delete_message(chat_id=message.chat.id, message_id=current_id)
-        except TelegramNotFound:
-            # Логируем, но игнорируем ошибку "сообщение для удаления не найдено".
-            logger.warning(
-                f"Сообщение %s {current_id} не найдено для удаления.")
-        except TelegramBadRequest as e:
-            # Логируем неожиданные ошибки и продолжаем с другими сообщениями.
-            logger.error(
-                f"Ошибка при удалении сообщения %s {current_id}: {e}", exc_info=True)
-        finally:
-            # В любом случае, продолжаем с следующим ID.
-            current_id -= 1
+    logger.info("Удаление %s сообщений диалога исключая %s",
+                len(message_ids), exclude_ids)
+    await delete_messages(bot, message.chat.id, sorted(set(message_ids)))
 
 
 @form_router.message(LongTextFilter())
@@ -208,28 +253,25 @@ async def process_long_text(message: Message, state: FSMContext = None):
     }
     keyboard = get_keyboard(buttons_data)
 
-    response = redmine_req.show_top10_user_tasks(
+    issues = await redmine_req.top_user_issues(
         message.from_user.username or 'unknown', 1)
 
     number_of_files = data.get("number_of_files", 0)
 
-    match = re.search(r">(\d+)</a>", response)
-    if match:
-        task_number = match.group(1)
-    else:
-        logger.error(f"No match found in: %s {response}")
+    if isinstance(issues, str) or not issues:
+        logger.error("Не найдена последняя задача: %s", issues)
         return
 
     data = {
         "long_text": long_text,
-        "task_number": task_number,
+        "task_number": str(issues[0].id),
         "username": message.from_user.username or 'unknown',
     }
 
     await state.update_data(**data)
     message_form = (f"Как поступить с Вашим комментарием?\nДобавить в последнюю задачу,\nвыбрать задачу из списка или создать новую?\n"
                     f"{html.bold('Вложенных файлов: ')}{number_of_files}\n--------\n"
-                    f"Последняя задача:\n{response}")
+                    f"Последняя задача:\n{render_issue_list(issues)}")
     await message.answer(message_form, reply_markup=keyboard)
 
 
@@ -305,11 +347,13 @@ async def handle_replies(message: Message, state: FSMContext):
         }
         if files:
             kwargs['files'] = files
+        if data.get('rejected_files'):
+            kwargs['rejected_files'] = data['rejected_files']
 
         # Вызов функции command_add_comment
         response = await add_comment_with_attachment(**kwargs)
         await message.answer(response)
-        await state.clear()
+        await clear_state(state)
     else:
         await message.answer("Не могу найти номер задачи... :(")
 
@@ -319,7 +363,7 @@ async def command_add_comment(message: Message, state: FSMContext):
     data = await state.get_data()
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
 
-    async def create_response_and_clear(username, task_number, comment, files=None):
+    async def create_response_and_clear(username, task_number, comment, files=None, rejected_files=None):
         kwargs = {
             'login': username,
             'chat_id': message.chat.id,
@@ -328,9 +372,11 @@ async def command_add_comment(message: Message, state: FSMContext):
         }
         if files:
             kwargs['files'] = files
+        if rejected_files:
+            kwargs['rejected_files'] = rejected_files
 
         response = await add_comment_with_attachment(**kwargs)
-        await state.clear()
+        await clear_state(state)
         return response
 
     if 'long_text' in data:
@@ -343,9 +389,9 @@ async def command_add_comment(message: Message, state: FSMContext):
             files = data.get('downloads')
 
         response = await create_response_and_clear(
-            username, data['task_number'], data['long_text'], files)
+            username, data['task_number'], data['long_text'], files, data.get('rejected_files'))
         await message.answer(response)
-        await state.clear()
+        await clear_state(state)
         return
 
     stripped_text = message.text.replace('/add_comment', '').strip()
@@ -365,7 +411,7 @@ async def command_add_comment(message: Message, state: FSMContext):
             response = await create_response_and_clear(
                 message.from_user.username or 'unknown', task_number, comment)
             await message.answer(response)
-            await state.clear()
+            await clear_state(state)
             return
 
         else:
@@ -376,7 +422,7 @@ async def command_add_comment(message: Message, state: FSMContext):
         await message.answer("Пожалуйста, укажите номер задачи.")
 
         data = {
-            "operation": add_comment_with_attachment,
+            "operation": "add_comment",
             "action": "Добавляю комментарий к задаче №",
             "comment": stripped_text
         }
@@ -386,7 +432,7 @@ async def command_add_comment(message: Message, state: FSMContext):
 @form_router.message(Command("show_task"))
 @form_router.message(lambda message: re.match(r'^покажи задачу(\s\d+)?$', message.text, re.IGNORECASE))
 async def command_show_task(message: Message, state: FSMContext):
-    await state.update_data(operation=redmine_req.show_task, action="Показываю задачу")
+    await state.update_data(operation="show_task", action="Показываю задачу")
     chat_id = message.chat.id
     # await state.update_data(action="Показываю задачу")
     username = message.from_user.username or 'unknown'
@@ -395,10 +441,10 @@ async def command_show_task(message: Message, state: FSMContext):
     if match:
         task_number = int(match.group())
         await state.update_data(task_number=task_number)
-        response = redmine_req.show_task(username, task_number, chat_id)
+        response = await redmine_req.show_task(username, task_number, chat_id)
 
         await message.answer(response)
-        await state.clear()
+        await clear_state(state)
 
     else:
         await state.set_state(Form.task_number)
@@ -415,22 +461,22 @@ async def process_task_number(message: Message, state: FSMContext) -> None:
         await cancel_handler(message, state)
         return
 
-    async def process_attachments() -> str:
+    async def process_attachments() -> dict:
         await process_download_files(state)
-        updated_data = await state.get_data()
-        return updated_data.get('downloads', '')
+        return await state.get_data()
 
     if long_text:
         task_match = re.search(r'\d+', message.text)
-        files = await process_attachments() if uploads else ''
+        attachments = await process_attachments() if uploads else data
 
         if task_match:
             task_number = int(task_match.group(0))
             response = await add_comment_with_attachment(
-                message.from_user.username or 'unknown', message.chat.id, task_number, long_text, files
+                message.from_user.username or 'unknown', message.chat.id, task_number, long_text,
+                attachments.get('downloads', ''), attachments.get('rejected_files')
             )
             await message.answer(response, reply_markup=ReplyKeyboardRemove())
-            await state.clear()
+            await clear_state(state)
             return
 
     if message.text.isdigit():
@@ -445,7 +491,7 @@ async def process_task_number(message: Message, state: FSMContext) -> None:
 
 @form_router.message(Form.show_task, F.text.casefold() == "нет")
 async def process_dont_show_task(message: Message, state: FSMContext) -> None:
-    await state.clear()
+    await clear_state(state)
     await message.answer("Нет, так нет...", reply_markup=ReplyKeyboardRemove())
 
 
@@ -469,7 +515,7 @@ async def process_show_task(message: Message, state: FSMContext) -> None:
         reply_markup=ReplyKeyboardRemove(),
     )
 
-    response = data['operation'](*args)
+    response = await OPERATIONS[data['operation']](*args)
     await message.answer(response)
 
 
@@ -494,21 +540,36 @@ async def command_create_task_form(message: Message, state: FSMContext):
 
     keyboard = get_keyboard(buttons_data, buttons_order)
 
-    default_project = await get_data_by_key(
-        data['username'], "projects", 1)
-    project = data.get('project_name', default_project['name'])
-
-    default_tracker = data.get('tracker_name', await get_data_by_key(
-        data['username'], "trackers", 1))
+    project = data.get('project_name')
+    if not project:
+        default_project = await get_data_by_key(
+            data['username'], "projects", 1)
+        if isinstance(default_project, str):
+            await message.answer(default_project)
+            return
+        project = default_project['name']
+
+    default_tracker = data.get('tracker_name')
+    if not default_tracker:
+        default_tracker = await get_data_by_key(
+            data['username'], "trackers", 1)
+        if isinstance(default_tracker, str):
+            await message.answer(default_tracker)
+            return
+        if default_tracker is None:
+            await message.answer("В Редмайне нет ни одного трекера. Обратитесь к вашему админу.")
+            return
+        default_tracker = default_tracker['name']
 
     default_priority = data.get('priority_state', 'Обязательно')
     default_subject = data.get(
         'create_subject', "Будет задана при создании задачи")
 
-    number_of_files = data.get("number_of_files", 0)
-
     if "uploads" in data:
         await process_download_files(state)
+        data = await state.get_data()
+
+    number_of_files = data.get("number_of_files", 0)
 
     message_form = (
         f"{html.bold('Создание новой задачи')}\n\n"
@@ -530,6 +591,9 @@ async def command_create_task_form(message: Message, state: FSMContext):
         sent_message = await message.answer(message_form+message_bottom, reply_markup=keyboard)
         # Сохраняем ID сообщения в состоянии
         await state.update_data(message_id=sent_message.message_id)
+        # Состояние отмечает идущий диалог: по нему запоминаются его сообщения
+        if await state.get_state() is None:
+            await state.set_state(Form.message_id)
 
 
 @form_router.message(Command("create_task"))
@@ -557,7 +621,7 @@ async def process_description(message: Message, state: FSMContext) -> None:
         await state.set_state(Form.create_subject)
         await message.answer("Напишите тему для задачи:", reply_markup=ReplyKeyboardRemove())
     else:
-        await state.clear()
+        await clear_state(state)
         await message.answer("Нет так нет...", reply_markup=ReplyKeyboardRemove())
 
 
@@ -571,6 +635,8 @@ async def process_subject(message: Message, state: FSMContext) -> None:
     if all(key in data for key in required_keys):
 
         await command_create_task_form(message, state)
+        # Форма могла скачать новые файлы
+        data = await state.get_data()
         kwargs = {
             'login': data.get('username', message.from_user.username or 'unknown'),
             'chat_id': message.chat.id,
@@ -579,7 +645,8 @@ async def process_subject(message: Message, state: FSMContext) -> None:
             'priority': data.get('priority_state'),
             'project': int(data['project_id']) if 'project_id' in data else None,
             'tracker_id': int(data['tracker_id']) if 'tracker_id' in data else None,
-            'downloads': data.get('downloads')
+            'downloads': data.get('downloads'),
+            'rejected_files': data.get('rejected_files')
         }
 
         # Убираем None значения из kwargs
@@ -587,8 +654,8 @@ async def process_subject(message: Message, state: FSMContext) -> None:
         response = await create_task(**kwargs)
 
         bot_response = await message.answer(response, reply_markup=ReplyKeyboardRemove())
-        await delete_messages_until(message, data['message_id'], exclude_ids=[bot_response.message_id])
-        await state.clear()
+        await delete_messages_until(message, data, exclude_ids=[bot_response.message_id])
+        await clear_state(state)
 
     else:
         await state.set_state(Form.create_priority)
@@ -619,7 +686,7 @@ async def ask_priority(message: Message, state: FSMContext) -> None:
             username, chat_id, data['create_subject'], data['description'])
 
         await message.answer(response, reply_markup=ReplyKeyboardRemove())
-        await state.clear()
+        await clear_state(state)
 
 
 @form_router.message(Form.priority_state)
@@ -642,7 +709,8 @@ async def process_priority_choice(message: Message, state: FSMContext) -> None:
         'priority': data.get('priority_state'),
         'project': int(data['project_id']) if 'project_id' in data else None,
         'tracker_id': int(data['tracker_id']) if 'tracker_id' in data else None,
-        'downloads': data.get('downloads')
+        'downloads': data.get('downloads'),
+        'rejected_files': data.get('rejected_files')
     }
 
     # Убираем None значения из kwargs
@@ -651,8 +719,8 @@ async def process_priority_choice(message: Message, state: FSMContext) -> None:
     response = await create_task(**kwargs)
 
     bot_response = await message.answer(response, reply_markup=ReplyKeyboardRemove())
-    await delete_messages_until(message, data['message_id'], exclude_ids=[bot_response.message_id])
-    await state.clear()
+    await delete_messages_until(message, data, exclude_ids=[bot_response.message_id])
+    await clear_state(state)
 
 
 @form_router.message(Form.project_id)
@@ -687,17 +755,18 @@ async def command_show_top10(message: Message, state: FSMContext):
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
     data = await state.get_data()
     if 'long_text' in data:
-        response = redmine_req.show_top10_user_tasks(data['username'])
-        pattern = r"Задача #<a href=\'.+?/(\d+)\'>.+?</a>:</i></b></u> (.+?)\s*(?=<|\n|$)"
-        matches = re.findall(pattern, response)
-        results = [' '.join(match) for match in matches]
+        issues = await redmine_req.top_user_issues(data['username'])
+        if isinstance(issues, str):
+            await message.answer(issues)
+            return
+        results = [f"{issue.id} {issue.subject}" for issue in issues]
 
         keyboard = get_reply_keyboard(results)
 
         await message.answer("Выберете задачу:", reply_markup=keyboard)
 
     else:
-        response = redmine_req.show_top10_user_tasks(
+        response = await redmine_req.show_top10_user_tasks(
             message.from_user.username or 'unknown')
         await message.answer(response)
 
@@ -707,20 +776,21 @@ async def command_get_selectors(message: Message, state: FSMContext):
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
     data = await state.get_data()
     key = data['selector_key']
+
+    data = await get_data_by_key(data['username'], key)
+    if isinstance(data, str):
+        await message.answer(data)
+        return
+
     if 'Проект' == key:
         await state.set_state(Form.project_id)
     if 'Трекер' == key:
         await state.set_state(Form.tracker_id)
 
-    data = await get_data_by_key(data['username'], key)
     results = []
-
-    if isinstance(data, str):
-        return data
-    else:
-        for item in data:
-            result = f"{item['name']} | ID: {item['id']}"
-            results.append(result)
+    for item in data:
+        result = f"{item['name']} | ID: {item['id']}"
+        results.append(result)
 
     keyboard = get_reply_keyboard(results)
 
@@ -733,10 +803,25 @@ async def command_count_my_tasks(message: Message):
     await bot.send_chat_action(chat_id=message.chat.id, action="typing")
 
     username = message.from_user.username or 'unknown'
-    response = redmine_req.number_of_open_tasks(username)
+    response = await redmine_req.number_of_open_tasks(username)
     await message.answer(response)
 
 
+@form_router.message(Command("refresh_reference"))
+async def command_refresh_reference(message: Message):
+    await bot.send_chat_action(chat_id=message.chat.id, action="typing")
+    # Справочники грузятся ключом администратора, поэтому обновлять их могут только пользователи Редмайна
+    username = message.from_user.username or 'unknown'
+    _, user_id, _ = await get_api_key_and_login_from_telegram(username, message.chat.id)
+    if not user_id:
+        logger.info("Отказано в обновлении справочников пользователю %s", username)
+        await message.answer(f"Пользователь с именем {html.quote(username)} не найден в Redmine.")
+        return
+
+    await reference_data.refresh()
+    await message.answer("Справочники Редмайна обновлены.")
+
+
 @form_router.message(CommandStart())
 @form_router.message(F.text.casefold() == "помощь" or F.text.casefold() == "/help")
 async def command_help_handler(message: Message) -> None:
@@ -752,9 +837,12 @@ async def command_help_handler(message: Message) -> None:
 - `/create_task` — создание новой задачи, например `/create_task Описание для задачи...`
 - `/add_comment <номер> <комментарий>` — добавление комментария к задаче, например: `/add_comment 110022 Отличная работа!`.
 
+⚙️ СЛУЖЕБНОЕ
+- `/refresh_reference` — заново загрузить из Редмайна статусы, трекеры и приоритеты, если их изменили.
+
 📝 Если введённый вами текст содержит более 5 слов, я предложу варианты действий с ним. Также вы можете отправить файл с короткой подписью, и я также предложу варианты действий.
 
-💼 При загрузке нескольких файлов: пожалуйста, не добавляйте комментарий к группе файлов — я его не учту. Если хотите создать задачу с файлами, лучше отправьте комментарий отдельно после загрузки. Или загрузите несколько файлов, а последний — с нужной подписью, чтобы вызвать меню действий.
+💼 Несколько файлов можно отправить одним альбомом с подписью: я дождусь всех файлов альбома и один раз предложу варианты действий с подписью. Если ответить альбомом на сообщение о задаче, файлы и подпись добавятся к ней комментарием. Можно и отправить файлы без подписи, а комментарий — отдельным сообщением после них.
 """
 
     await message.answer(f"Привет, {message.from_user.full_name}!\n{help_message}", parse_mode='Markdown')
@@ -763,7 +851,7 @@ async def command_help_handler(message: Message) -> None:
 @form_router.message(Command("cancel"))
 @form_router.message(F.text.casefold() == "отмена")
 async def cancel_handler(message: Message, state: FSMContext) -> None:
-    await state.clear()
+    await clear_state(state)
     """
     Allow user to cancel any action
     """
@@ -772,15 +860,62 @@ async def cancel_handler(message: Message, state: FSMContext) -> None:
         return
 
     logger.info("Cancelling state %r", current_state)
-    await state.clear()
+    await clear_state(state)
     await message.answer(
         "Cancelled.",
         reply_markup=ReplyKeyboardRemove(),
     )
 
 
-async def main():
-    dp = Dispatcher()
+def create_dispatcher() -> Dispatcher:
+    if FSM_STORAGE != 'redis':
+        return Dispatcher()
+    # Состояние диалогов в Redis переживает перезапуск и общее для всех реплик бота
+    storage = RedisStorage(
+        async_redis_conn,
+        key_builder=DefaultKeyBuilder(prefix='telegram_fsm'),
+        state_ttl=FSM_STATE_TTL_SECONDS,
+        data_ttl=FSM_STATE_TTL_SECONDS,
+        json_dumps=partial(json.dumps, ensure_ascii=False, separators=(',', ':')),
+    )
+    # Апдейты одного пользователя обрабатываются по очереди, даже если пришли на разные реплики
+    return Dispatcher(storage=storage, events_isolation=storage.create_isolation())
+
+
+async def setup() -> Dispatcher:
+    dp = create_dispatcher()
     dp.include_router(form_router)
+    # Альбом сохраняется в состояние вне апдейта, но под той же блокировкой
+    media_groups.isolation = dp.fsm.events_isolation
+    await reference_data.start()
+    await membership_index.start()
+    api_key_refresher.start()
+    task = asyncio.create_task(remove_expired_forever())
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return dp
+
+
+async def start_webhook(app: web.Application) -> None:
+    """Регистрирует обработчик апдейтов Telegram на сервере вебхуков и сам вебхук в Telegram.
+
+    Вызывается до запуска сервера, после runner.setup() маршруты уже не добавить.
+    """
+    if not TELEGRAM_SECRET_TOKEN:
+        raise RuntimeError(
+            "Для update_mode = webhook нужна переменная окружения TELEGRAM_SECRET_TOKEN")
+    if not WEBHOOK_URL:
+        raise RuntimeError(
+            "Для update_mode = webhook нужен webhook_url в секции [Telegram] config.ini")
+    dp = await setup()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=TELEGRAM_SECRET_TOKEN).register(
+        app, path=WEBHOOK_PATH)
+    # Все реплики регистрируют один и тот же адрес, повторный вызов ничего не меняет
+    await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=TELEGRAM_SECRET_TOKEN,
+                          allowed_updates=dp.resolve_used_update_types())
+
+
+async def main():
+    dp = await setup()
     await bot(DeleteWebhook(drop_pending_updates=True))
     await dp.start_polling(bot)
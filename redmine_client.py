@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+from functools import partial
+from typing import Awaitable, BinaryIO, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+import aiohttp
+from redmine_resilience import RedmineServerError, guarded, read
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+REDMINE_URL = config['Redmine']['url']
+CONNECTIONS_PER_HOST = config['Redmine'].getint(
+    'connections_per_host', fallback=10)
+TIMEOUT_SECONDS = config['Redmine'].getint('timeout_seconds', fallback=30)
+DOWNLOAD_TIMEOUT_SECONDS = config['Redmine'].getint(
+    'download_timeout_seconds', fallback=300)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+T = TypeVar('T')
+
+
+class DownloadTooLarge(Exception):
+    pass
+
+
+class SingleFlight:
+    """Одинаковые одновременные запросы выполняются один раз, результат получают все."""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        del self._calls[key]
+        # Ошибку могли не забрать, если все ожидавшие отменены
+        if not future.cancelled():
+            future.exception()
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[T]]) -> T:
+        future = self._calls.get(key)
+        if future is None:
+            future = self._calls[key] = asyncio.ensure_future(func())
+            future.add_done_callback(partial(self._forget, key))
+        # Отмена одного ожидающего не должна отменять запрос для остальных
+        return await asyncio.shield(future)
+
+
+class RedmineClient:
+    """Асинхронный клиент REST API Редмайна на общей keep-alive сессии."""
+
+    def __init__(self, base_url: str, limit_per_host: int, timeout: int):
+        self.base_url = base_url.rstrip('/')
+        self.limit_per_host = limit_per_host
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._single_flight = SingleFlight()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # Сессия создаётся лениво, уже внутри запущенного event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit_per_host=self.limit_per_host, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                headers={
+                    'Accept': 'application/json',
+                    'Accept-Encoding': 'gzip, deflate'
+                })
+        return self._session
+
+    async def get_json(self, path: str, api_key: str, params: dict = None) -> Tuple[int, Optional[dict]]:
+        """GET запрос к Редмайну. Возвращает код ответа и разобранный JSON (только для 200).
+
+        Одновременные запросы одного ресурса с одним api ключом делят один HTTP
+        запрос и один и тот же JSON, менять его нельзя. Ключ - это и есть область
+        прав: видимость задачи, полей и приватных комментариев Редмайн считает по
+        ролям, статусу и авторству пользователя, и точнее её здесь не вычислить.
+        Поэтому склеиваются повторные нажатия одного пользователя и запросы с
+        ключом администратора (справочники, вложения), а когда одну задачу
+        открывают десятки разных людей, каждый из них делает свой запрос.
+        """
+        key = (path, api_key, tuple(sorted((params or {}).items())))
+        return await self._single_flight.do(key, partial(self._read_json, path, api_key, params))
+
+    async def _read_json(self, path: str, api_key: str, params: dict = None) -> Tuple[int, Optional[dict]]:
+        # Ошибки сервера повторяются и считаются предохранителем, но вызывающий по-прежнему получает код
+        try:
+            return await read(partial(self._get_json, path, api_key, params))
+        except RedmineServerError as e:
+            return e.status, None
+
+    async def _get_json(self, path: str, api_key: str, params: dict = None) -> Tuple[int, Optional[dict]]:
+        url = f"{self.base_url}/{path}"
+        headers = {'X-Redmine-API-Key': api_key}
+
+        async with self.session.get(url, headers=headers, params=params) as response:
+            if response.status >= 500:
+                raise RedmineServerError(response.status)
+            if response.status != 200:
+                return response.status, None
+            return response.status, await response.json(content_type=None)
+
+    async def download(self, path: str, api_key: str, file: BinaryIO, max_size: int) -> int:
+        """Потоковое скачивание в file без буферизации всего ответа. Возвращает код ответа.
+
+        Без повторов: часть файла уже могла быть записана.
+        """
+        return await guarded(partial(self._download, path, api_key, file, max_size), DOWNLOAD_TIMEOUT_SECONDS)
+
+    async def _download(self, path: str, api_key: str, file: BinaryIO, max_size: int) -> int:
+        url = f"{self.base_url}/{path}"
+        headers = {'X-Redmine-API-Key': api_key}
+        timeout = aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT_SECONDS)
+
+        async with self.session.get(url, headers=headers, timeout=timeout) as response:
+            if response.status != 200:
+                return response.status
+
+            if (response.content_length or 0) > max_size:
+                raise DownloadTooLarge(
+                    f"{url}: {response.content_length} байт")
+
+            size = 0
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_size:
+                    raise DownloadTooLarge(f"{url}: больше {max_size} байт")
+                file.write(chunk)
+
+            return response.status
+
+    async def close(self):
+        if self._session and not self._session.closed:
+            await self._session.close()
+
+
+redmine_client = RedmineClient(
+    REDMINE_URL, CONNECTIONS_PER_HOST, TIMEOUT_SECONDS)
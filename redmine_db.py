@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+from typing import AsyncIterator, Optional
+import aiomysql
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# Пароль добавляется в словарь при запуске, после расшифровки (см. get_api_key.decrypt_password)
+DATABASE_CONFIG = {
+    'host': config['Database']['host'],
+    'user': config['Database']['user'],
+    'database': config['Database']['database']
+}
+
+POOL_SIZE = config['Database'].getint('pool_size', fallback=5)
+POOL_RECYCLE_SECONDS = config['Database'].getint(
+    'pool_recycle_seconds', fallback=3600)
+CONNECT_TIMEOUT_SECONDS = config['Database'].getint(
+    'connect_timeout_seconds', fallback=10)
+
+_pool: Optional[aiomysql.Pool] = None
+_pool_lock = asyncio.Lock()
+
+
+async def get_pool() -> aiomysql.Pool:
+    """Ленивое создание ограниченного пула соединений к базе Редмайна."""
+    global _pool
+    async with _pool_lock:
+        if _pool is None:
+            _pool = await aiomysql.create_pool(
+                minsize=1,
+                maxsize=POOL_SIZE,
+                pool_recycle=POOL_RECYCLE_SECONDS,
+                connect_timeout=CONNECT_TIMEOUT_SECONDS,
+                autocommit=True,
+                host=DATABASE_CONFIG['host'],
+                user=DATABASE_CONFIG['user'],
+                password=DATABASE_CONFIG.get('password', ''),
+                db=DATABASE_CONFIG['database'])
+            logger.info("Создан пул соединений к базе Редмайна (до %s)",
+                        POOL_SIZE)
+    return _pool
+
+
+async def execute(query: str, args=None, fetch: str = 'all'):
+    """Выполнение запроса на соединении из пула.
+
+    Если сервер уже закрыл соединение (wait_timeout, рестарт MySQL),
+    оно отбрасывается и запрос повторяется один раз на новом.
+    """
+    pool = await get_pool()
+    for attempt in (1, 2):
+        async with pool.acquire() as conn:
+            try:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(query, args)
+                    if fetch == 'one':
+                        return await cursor.fetchone()
+                    return await cursor.fetchall()
+            except aiomysql.OperationalError as e:
+                conn.close()
+                if attempt == 2:
+                    raise
+                logger.warning(
+                    "Соединение с базой Редмайна потеряно, повторяю запрос: %s", e)
+
+
+async def fetchone(query: str, args=None):
+    return await execute(query, args, fetch='one')
+
+
+async def fetchall(query: str, args=None):
+    return await execute(query, args, fetch='all')
+
+
+async def iterate(query: str, args=None, batch_size: int = 1000) -> AsyncIterator[tuple]:
+    """Потоковое чтение большого результата пачками по batch_size строк.
+
+    Строки идут с сервера по мере чтения (SSCursor), весь результат в памяти не держится.
+    """
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        async with conn.cursor(aiomysql.SSCursor) as cursor:
+            await cursor.execute(query, args)
+            while True:
+                rows = await cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        await _pool.wait_closed()
+        _pool = None
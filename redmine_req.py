@@ -1,8 +1,12 @@
 #!/usr/bin/env python
+import html
 import json
 import configparser
 import logging
-import requests
+from typing import List, NamedTuple, Union
+from redmine_client import redmine_client
+from issue_cache import issue_cache
+from redmine_sql import count_open_issues, top_open_issues
 from get_api_key import get_api_key_and_login_from_telegram
 
 logger = logging.getLogger(__name__)
@@ -10,6 +14,8 @@ logger = logging.getLogger(__name__)
 config = configparser.ConfigParser()
 config.read('config.ini')
 REDMINE_URL = config['Redmine']['url']
+# rest - всё через REST API, sql - счётчики и списки задач напрямую из базы Редмайна
+READ_ENGINE = config['Redmine'].get('read_engine', fallback='rest')
 
 # Словарь алиасов для ключей
 with open('aliases.json', 'r', encoding='utf-8') as file:
@@ -18,9 +24,24 @@ with open('aliases.json', 'r', encoding='utf-8') as file:
 KEY_ALIASES = data['requests'][0]
 
 
+class IssueSummary(NamedTuple):
+    id: int
+    subject: str
+
+
+def render_issue_list(issues: List[IssueSummary]) -> str:
+    """Список задач в HTML для Telegram."""
+    tasks = []
+    for issue in issues:
+        tasks.append(
+            f"<u><b><i>Задача #<a href='{REDMINE_URL}/{issue.id}'>{issue.id}</a>:</i></b></u> {html.escape(issue.subject)}")
+
+    return '\r\n'.join(tasks)
+
+
 class RedmineRequests:
-    def show_task(self, login: str, task_number: int, chat_id: int):
-        api_key, user_id, _ = get_api_key_and_login_from_telegram(
+    async def show_task(self, login: str, task_number: int, chat_id: int):
+        api_key, user_id, _ = await get_api_key_and_login_from_telegram(
             login, chat_id)
 
         if not user_id:
@@ -28,60 +49,76 @@ class RedmineRequests:
                 f"Пользователь с именем %s {login} не найден в Redmine.")
             return f'Пользователь с именем {login} не найден в Redmine.'
 
-        url = f"{REDMINE_URL}/issues/{task_number}.json?include=journals"
-        headers = {'X-Redmine-API-Key': api_key}
+        cached = issue_cache.get(task_number, user_id)
+        if cached and (cached.fresh or await self.is_issue_unchanged(api_key, task_number, cached.updated_on)):
+            cached.touch()
+            return cached.rendered
 
         try:
-            http_response = requests.get(url, headers=headers, timeout=30)
+            status, response_json = await redmine_client.get_json(
+                f"issues/{task_number}.json", api_key, params={'include': 'journals'})
         except Exception as e:
             logger.error(f"Ошибка при запросе к Redmine. Причина: %s {e}")
             return "Сервер Редмайн не доступен. Обратитесь к вашему админу."
 
-        # пустой список для хранения ответов
-        responses = []
-
-        if http_response.status_code == 200:
-            issue_data = http_response.json()['issue']
-            keys = issue_data.keys()
-
-            # Вывести информацию для каждого ключа
-            for key in keys:
-                if key in issue_data and key != "custom_fields":
-                    value = issue_data[key]
-
-                    if isinstance(value, dict) and 'name' in value:
-                        value = value['name']
-
-                    # Обработка комментариев
-                    elif key == 'journals':
-                        comments = []
-                        for journal in value:
-                            if 'notes' in journal and journal['notes']:
-                                comment_author = journal['user'][
-                                    'name'] if 'user' in journal and 'name' in journal['user'] else 'Неизвестный'
-                                comments.append(
-                                    f"{comment_author}: {journal['notes']}")
-                        value = '\r\n'.join(comments)
-
-                    russian_key = KEY_ALIASES.get(key, key)
-                    if key == "id":
-                        responses.append(
-                            f"<u><b><i>{russian_key}:</i></b></u> <a href='{REDMINE_URL}/{task_number}'>{value}</a>")
-                    else:
-                        responses.append(
-                            f"<u><b><i>{russian_key}:</i></b></u> {value}")
-
-        else:
+        if status != 200:
             logger.error(
-                f"Ошибка при запросе к Redmine. Код состояния: %s {http_response.status_code}")
-            return f"Ошибка при запросе к Redmine. Код состояния: {http_response.status_code}"
+                f"Ошибка при запросе к Redmine. Код состояния: %s {status}")
+            return f"Ошибка при запросе к Redmine. Код состояния: {status}"
 
-        final_response = '\r\n'.join(responses)
+        issue_data = response_json['issue']
+        final_response = self.render_issue(issue_data, task_number)
+        issue_cache.put(task_number, user_id, issue_data, final_response)
 
         return final_response
 
-    def show_top10_user_tasks(self, login: str, num: int = 10):
-        api_key, user_id, _ = get_api_key_and_login_from_telegram(
+    async def is_issue_unchanged(self, api_key: str, task_number: int, updated_on: str) -> bool:
+        """Дешёвая проверка updated_on без журналов для устаревшей записи кэша."""
+        params = {'issue_id': task_number, 'status_id': '*', 'limit': 1}
+        try:
+            status, response_json = await redmine_client.get_json(
+                "issues.json", api_key, params=params)
+        except Exception:
+            return False
+
+        if status != 200 or not response_json.get('issues'):
+            return False
+        return response_json['issues'][0].get('updated_on') == updated_on
+
+    def render_issue(self, issue_data: dict, task_number: int) -> str:
+        # пустой список для хранения ответов
+        responses = []
+
+        # Вывести информацию для каждого ключа
+        for key, value in issue_data.items():
+            if key != "custom_fields":
+                if isinstance(value, dict) and 'name' in value:
+                    value = value['name']
+
+                # Обработка комментариев
+                elif key == 'journals':
+                    comments = []
+                    for journal in value:
+                        if 'notes' in journal and journal['notes']:
+                            comment_author = journal['user'][
+                                'name'] if 'user' in journal and 'name' in journal['user'] else 'Неизвестный'
+                            comments.append(
+                                f"{comment_author}: {journal['notes']}")
+                    value = '\r\n'.join(comments)
+
+                russian_key = KEY_ALIASES.get(key, key)
+                if key == "id":
+                    responses.append(
+                        f"<u><b><i>{russian_key}:</i></b></u> <a href='{REDMINE_URL}/{task_number}'>{value}</a>")
+                else:
+                    responses.append(
+                        f"<u><b><i>{russian_key}:</i></b></u> {value}")
+
+        return '\r\n'.join(responses)
+
+    async def top_user_issues(self, login: str, num: int = 10) -> Union[List[IssueSummary], str]:
+        """Последние открытые задачи пользователя или текст ошибки."""
+        api_key, user_id, _ = await get_api_key_and_login_from_telegram(
             login)
 
         if not user_id:
@@ -91,39 +128,44 @@ class RedmineRequests:
 
         maxlimit = 10
         num = min(num, maxlimit)
-        url = f"{REDMINE_URL}/issues.json?assigned_to_id={user_id}&status_id=1,2,3&limit={num}"
-        headers = {'X-Redmine-API-Key': api_key}
+
+        if READ_ENGINE == 'sql':
+            rows = await top_open_issues(user_id, num)
+            if rows is not None:
+                return [IssueSummary(*row) for row in rows]
+
+        params = {'assigned_to_id': user_id,
+                  'status_id': '1,2,3', 'limit': num}
 
         try:
-            http_response = requests.get(url, headers=headers, timeout=30)
+            status, response_json = await redmine_client.get_json(
+                "issues.json", api_key, params=params)
         except Exception as e:
             logger.error(f"Ошибка при запросе к Redmine. Причина: %s {e}")
             return "Сервер Редмайн не доступен. Обратитесь к вашему админу."
 
-        tasks = []
+        if status != 200:
+            logger.error(
+                f"Ошибка при запросе к Redmine. Код состояния: %s {status}")
+            return f'Ошибка при запросе к Redmine. Код состояния: {status}'
 
-        if http_response.status_code == 200:
-            issues = http_response.json()['issues']
-            if issues:
-                for issue in issues:
-                    issue_id = issue['id']
-                    subject = issue['subject']
-                    tasks.append(
-                        f"<u><b><i>Задача #<a href='{REDMINE_URL}/{issue_id}'>{issue_id}</a>:</i></b></u> {subject}")
+        return [IssueSummary(issue['id'], issue['subject'])
+                for issue in response_json['issues']]
 
-                return '\r\n'.join(tasks)
-            else:
-                logger.info(
-                    f"На пользователя %s {user_id} нет открытых задач.")
-                return f"На пользователя {user_id} нет открытых задач."
+    async def show_top10_user_tasks(self, login: str, num: int = 10) -> str:
+        issues = await self.top_user_issues(login, num)
+        if isinstance(issues, str):
+            return issues
 
-        else:
-            logger.error(
-                f"Ошибка при запросе к Redmine. Код состояния: %s {http_response.status_code}")
-            return f'Ошибка при запросе к Redmine. Код состояния: {http_response.status_code}'
+        if not issues:
+            logger.info(
+                f"На пользователя %s {login} нет открытых задач.")
+            return f"На пользователя {login} нет открытых задач."
+
+        return render_issue_list(issues)
 
-    def number_of_open_tasks(self, login: str):
-        api_key, user_id, _ = get_api_key_and_login_from_telegram(
+    async def number_of_open_tasks(self, login: str):
+        api_key, user_id, _ = await get_api_key_and_login_from_telegram(
             login)
 
         if not user_id:
@@ -131,21 +173,28 @@ class RedmineRequests:
                 f"Пользователь с именем %s {login} не найден в Redmine.")
             return f'Пользователь с именем {login} не найден в Redmine.'
 
-        url = f'{REDMINE_URL}/issues.json?assigned_to_id={user_id}&status_id=1,2,3&limit=100'
-        headers = {'X-Redmine-API-Key': api_key}
+        total_issues = None
+        if READ_ENGINE == 'sql':
+            total_issues = await count_open_issues(user_id)
 
-        try:
-            http_response = requests.get(url, headers=headers, timeout=30)
-        except Exception as e:
-            logger.error(f"Ошибка при запросе к Redmine. Причина: %s {e}")
-            return "Сервер Редмайн не доступен. Обратитесь к вашему админу."
+        if total_issues is None:
+            # Нужен только total_count, поэтому тела задач не запрашиваем
+            params = {'assigned_to_id': user_id,
+                      'status_id': '1,2,3', 'limit': 1}
 
-        if http_response.status_code == 200:
-            total_issues = http_response.json().get(
+            try:
+                status, response_json = await redmine_client.get_json(
+                    "issues.json", api_key, params=params)
+            except Exception as e:
+                logger.error(f"Ошибка при запросе к Redmine. Причина: %s {e}")
+                return "Сервер Редмайн не доступен. Обратитесь к вашему админу."
+
+            if status != 200:
+                logger.error(
+                    f"Ошибка при запросе к Redmine. Код состояния: %s {status}")
+                return f"Ошибка при запросе к Redmine. Код состояния: {status}"
+
+            total_issues = response_json.get(
                 'total_count', 0)  # Получаем общее количество задач
 
-            return f"У Вас {total_issues} открытых задач."
-        else:
-            logger.error(
-                f"Ошибка при запросе к Redmine. Код состояния: %s {http_response.status_code}")
-            return f"Ошибка при запросе к Redmine. Код состояния: {http_response.status_code}"
+        return f"У Вас {total_issues} открытых задач."
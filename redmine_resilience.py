@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+import random
+from functools import partial
+from time import monotonic
+from typing import Awaitable, Callable, TypeVar
+import aiohttp
+import requests
+from redminelib.exceptions import ServerError
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+# Время на всю операцию чтения, включая повторы. По умолчанию - как у любого запроса к Редмайну
+READ_DEADLINE_SECONDS = config['Redmine'].getfloat(
+    'read_deadline_seconds', fallback=config['Redmine'].getfloat('timeout_seconds', fallback=30))
+READ_RETRIES = config['Redmine'].getint('read_retries', fallback=2)
+RETRY_BACKOFF_SECONDS = config['Redmine'].getfloat(
+    'retry_backoff_seconds', fallback=0.2)
+# 0 - без дублирующих запросов, иначе через столько секунд без ответа отправляется второй
+HEDGE_AFTER_SECONDS = config['Redmine'].getfloat(
+    'hedge_after_seconds', fallback=0)
+WRITE_DEADLINE_SECONDS = config['Redmine'].getfloat(
+    'write_deadline_seconds', fallback=120)
+BREAKER_FAILURE_THRESHOLD = config['Redmine'].getint(
+    'breaker_failure_threshold', fallback=5)
+BREAKER_RESET_SECONDS = config['Redmine'].getfloat(
+    'breaker_reset_seconds', fallback=30)
+
+T = TypeVar('T')
+
+
+class RedmineUnavailable(Exception):
+    """Редмайн не ответил вовремя, ответил ошибкой сервера или запросы к нему приостановлены."""
+
+
+class RedmineServerError(RedmineUnavailable):
+    def __init__(self, status: int):
+        super().__init__(f"Код состояния: {status}")
+        self.status = status
+
+
+class RedmineTimeout(RedmineUnavailable):
+    """Редмайн не ответил вовремя. Такой запрос не повторяется: второй будет так же долог."""
+
+
+# Редмайн не успел ответить. Проверяются раньше OUTAGE_ERRORS: таймауты aiohttp и requests
+# наследуются и от ошибок соединения
+TIMEOUT_ERRORS = (
+    asyncio.TimeoutError,
+    requests.exceptions.Timeout,
+)
+
+# Ошибки, которые говорят о проблемах с самим Редмайном, а не с запросом
+OUTAGE_ERRORS = (
+    aiohttp.ClientError,
+    requests.exceptions.ConnectionError,
+    ServerError,
+)
+
+
+class CircuitBreaker:
+    """Размыкается после failure_threshold сбоев подряд.
+
+    Пока цепь разомкнута, вызовы сразу получают RedmineUnavailable. Через
+    reset_seconds пропускается один пробный вызов: успех замыкает цепь,
+    сбой размыкает её снова.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None and (
+            self._probing or monotonic() - self.opened_at < self.reset_seconds)
+
+    def before_call(self):
+        if self.opened_at is None:
+            return
+        if self.is_open:
+            raise RedmineUnavailable("Запросы к Редмайну временно приостановлены")
+        self._probing = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Редмайн снова отвечает")
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.error(
+                    "Редмайн не отвечает, запросы приостановлены на %s с", self.reset_seconds)
+            self.opened_at = monotonic()
+        self._probing = False
+
+    def record_cancel(self):
+        # Отменённый пробный вызов ничего не показал, следующий вызов станет пробным
+        self._probing = False
+
+
+breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+
+
+async def attempt(call: Callable[[], Awaitable[T]], deadline: float) -> T:
+    """Один запрос к Редмайну с ограничением по времени, без учёта в предохранителе.
+
+    Сбои самого Редмайна превращаются в RedmineUnavailable (таймаут - в RedmineTimeout).
+    """
+    try:
+        return await asyncio.wait_for(call(), deadline)
+    except RedmineUnavailable:
+        raise
+    except TIMEOUT_ERRORS as e:
+        raise RedmineTimeout(str(e) or "Превышено время ожидания") from e
+    except OUTAGE_ERRORS as e:
+        raise RedmineUnavailable(str(e) or type(e).__name__) from e
+
+
+async def through_breaker(call: Callable[[], Awaitable[T]]) -> T:
+    """Вызов через предохранитель: одна логическая операция - один исход, сколько бы попыток в ней ни было."""
+    breaker.before_call()
+    try:
+        result = await call()
+    except RedmineUnavailable:
+        breaker.record_failure()
+        raise
+    except asyncio.CancelledError:
+        breaker.record_cancel()
+        raise
+    except Exception:
+        # Редмайн ответил, ошибка в самом запросе
+        breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+
+async def guarded(call: Callable[[], Awaitable[T]], deadline: float) -> T:
+    """Один вызов Редмайна через предохранитель и с ограничением по времени."""
+    return await through_breaker(partial(attempt, call, deadline))
+
+
+async def hedged(call: Callable[[], Awaitable[T]], deadline: float) -> T:
+    """Если первый запрос не ответил за HEDGE_AFTER_SECONDS, параллельно отправляется второй."""
+    if not HEDGE_AFTER_SECONDS or HEDGE_AFTER_SECONDS >= deadline:
+        return await attempt(call, deadline)
+
+    tasks = [asyncio.ensure_future(attempt(call, deadline))]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=HEDGE_AFTER_SECONDS)
+        if not done:
+            tasks.append(asyncio.ensure_future(
+                attempt(call, deadline - HEDGE_AFTER_SECONDS)))
+
+        pending = set(tasks)
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+            if not pending:
+                # Оба запроса не удались - отдаём ошибку последнего
+                return task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def read(call: Callable[[], Awaitable[T]], deadline: float = READ_DEADLINE_SECONDS,
+               retries: int = READ_RETRIES) -> T:
+    """Идемпотентное чтение: быстрые сбои повторяются со случайной паузой, общий дедлайн на все попытки.
+
+    Каждая попытка может занять всё оставшееся время: медленный, но живой Редмайн
+    успевает ответить. Таймаут не повторяется, а в предохранителе всё чтение
+    считается одним вызовом.
+    """
+    return await through_breaker(partial(_read, call, deadline, retries))
+
+
+async def _read(call: Callable[[], Awaitable[T]], deadline: float, retries: int) -> T:
+    loop = asyncio.get_running_loop()
+    deadline_at = loop.time() + deadline
+    for retry in range(retries + 1):
+        try:
+            return await hedged(call, deadline_at - loop.time())
+        except RedmineTimeout:
+            raise
+        except RedmineUnavailable as e:
+            if retry == retries:
+                raise
+            backoff = random.uniform(0, RETRY_BACKOFF_SECONDS * 2 ** retry)
+            if loop.time() + backoff >= deadline_at:
+                raise
+            logger.warning(
+                "Редмайн не ответил (%s), повтор через %.2f с", e, backoff)
+            await asyncio.sleep(backoff)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+import logging
+from typing import List, Optional, Tuple
+from redmine_db import fetchall, fetchone
+
+logger = logging.getLogger(__name__)
+
+# Те же условия, что и у issues.json?assigned_to_id=...&status_id=1,2,3:
+# открытые статусы 1, 2, 3, проект не в архиве, модуль задач включён,
+# и проект виден пользователю (он участник или проект публичный).
+OPEN_ISSUES_CONDITION = """
+    FROM issues AS i
+    JOIN projects AS p ON p.id = i.project_id
+    JOIN enabled_modules AS em ON em.project_id = p.id AND em.name = 'issue_tracking'
+    WHERE i.assigned_to_id = %s
+    AND i.status_id IN (1, 2, 3)
+    AND p.status IN (1, 5)
+    AND (p.is_public = 1 OR EXISTS (
+        SELECT 1 FROM members AS m
+        WHERE m.project_id = p.id AND m.user_id = i.assigned_to_id))
+"""
+
+OPEN_ISSUES_COUNT_QUERY = "SELECT COUNT(*)" + OPEN_ISSUES_CONDITION
+
+# Сортировка как у REST API по умолчанию - новые задачи первыми
+OPEN_ISSUES_TOP_QUERY = "SELECT i.id, i.subject" + \
+    OPEN_ISSUES_CONDITION + "ORDER BY i.id DESC LIMIT %s"
+
+
+async def count_open_issues(user_id) -> Optional[int]:
+    """Количество открытых задач пользователя или None, если база недоступна."""
+    try:
+        (total,) = await fetchone(OPEN_ISSUES_COUNT_QUERY, (user_id,))
+    except Exception as e:
+        logger.warning(
+            "Не удалось посчитать задачи в базе, запрос пойдёт через REST: %s", e)
+        return None
+    return total
+
+
+async def top_open_issues(user_id, limit: int) -> Optional[List[Tuple[int, str]]]:
+    """Последние открытые задачи пользователя (id, тема) или None, если база недоступна."""
+    try:
+        rows = await fetchall(OPEN_ISSUES_TOP_QUERY, (user_id, limit))
+    except Exception as e:
+        logger.warning(
+            "Не удалось получить задачи из базы, запрос пойдёт через REST: %s", e)
+        return None
+    return list(rows)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, List, Tuple, TypeVar
+from redminelib import Redmine
+from redminelib.engines import SyncEngine
+from redmine_resilience import WRITE_DEADLINE_SECONDS, guarded
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+REDMINE_URL = config['Redmine']['url']
+WRITE_THREADS = config['Redmine'].getint('write_threads', fallback=8)
+# Сколько клиентов (по одному на api ключ) держим с открытыми keep-alive соединениями
+MAX_CLIENTS = 256
+
+T = TypeVar('T')
+
+# python-redmine синхронный, поэтому все его вызовы идут в отдельном ограниченном пуле потоков
+executor = ThreadPoolExecutor(
+    max_workers=WRITE_THREADS, thread_name_prefix='redmine-writer')
+
+_clients: 'OrderedDict[str, Redmine]' = OrderedDict()
+
+
+class TimeoutEngine(SyncEngine):
+    """SyncEngine, который передаёт таймаут в каждый запрос.
+
+    requests.Session не читает атрибут timeout, а python-redmine кладёт опции
+    requests={...} именно в атрибуты сессии. Без таймаута зависший запрос
+    навсегда занимает поток пула: asyncio.wait_for в run_sync поток не останавливает.
+    """
+
+    timeout = WRITE_DEADLINE_SECONDS
+
+    def construct_request_kwargs(self, method, headers, params, data):
+        kwargs = super().construct_request_kwargs(method, headers, params, data)
+        kwargs['timeout'] = self.timeout
+        return kwargs
+
+
+def get_redmine(api_key: str) -> Redmine:
+    """Клиент Редмайна для api ключа. Внутри requests.Session, соединения переиспользуются."""
+    redmine = _clients.get(api_key)
+    if redmine is None:
+        redmine = _clients[api_key] = Redmine(
+            REDMINE_URL, key=api_key, engine=TimeoutEngine)
+        if len(_clients) > MAX_CLIENTS:
+            # Сессию не закрываем: вытесненным клиентом ещё может пользоваться поток пула,
+            # соединения закроются, когда на клиент не останется ссылок
+            _clients.popitem(last=False)
+    _clients.move_to_end(api_key)
+    return redmine
+
+
+async def run_sync(func: Callable[..., T], *args, **kwargs) -> T:
+    """Выполняет блокирующий вызов python-redmine в пуле потоков.
+
+    Без повторов: записи не идемпотентны. При недоступности Редмайна - RedmineUnavailable.
+    """
+    loop = asyncio.get_running_loop()
+    return await guarded(partial(loop.run_in_executor, executor, partial(func, *args, **kwargs)),
+                         WRITE_DEADLINE_SECONDS)
+
+
+async def upload_files(redmine: Redmine, files: List[dict]) -> Tuple[List[dict], List[str]]:
+    """Параллельная загрузка файлов в /uploads.json до сохранения задачи.
+
+    Возвращает вложения с токенами, которые issue.save() уже не загружает повторно,
+    и имена пропущенных файлов: пустых или уже удалённых из временной папки.
+    """
+    present = [file for file in files
+               if os.path.isfile(file['path']) and os.path.getsize(file['path']) > 0]
+    skipped = [file['filename'] for file in files if file not in present]
+    if skipped:
+        logger.warning("Файлы %s пусты или удалены, не загружаю", skipped)
+
+    tokens = await asyncio.gather(
+        *(run_sync(redmine.upload, file['path'], filename=file['filename']) for file in present))
+
+    return [{'token': token['token'], 'filename': file['filename']}
+            for file, token in zip(present, tokens)], skipped
+
+
+def shutdown():
+    executor.shutdown(wait=False, cancel_futures=True)
+    for redmine in _clients.values():
+        redmine.engine.session.close()
+    _clients.clear()
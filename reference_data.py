@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+from os import getenv
+from typing import Dict, List
+from redmine_client import redmine_client
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+REDMINE_ADMIN_API_KEY = getenv("REDMINE_ADMIN_API_KEY")
+REFRESH_SECONDS = config['Redmine'].getint(
+    'reference_data_refresh_seconds', fallback=3600)
+
+# Справочники, одинаковые для всех пользователей: ключ -> (путь в API, поле ответа)
+REFERENCE_ENDPOINTS = {
+    'status': ('issue_statuses.json', 'issue_statuses'),
+    'trackers': ('trackers.json', 'trackers'),
+    'priorities': ('enumerations/issue_priorities.json', 'issue_priorities'),
+}
+
+
+class ReferenceDataCache:
+    """Справочники Редмайна в памяти процесса.
+
+    Загружаются при старте, обновляются в фоне раз в REFRESH_SECONDS и по
+    команде. Если Редмайн не ответил, остаются прежние значения.
+    """
+
+    def __init__(self, refresh_seconds: int):
+        self.refresh_seconds = refresh_seconds
+        self._data: Dict[str, List[dict]] = {}
+        self._task = None
+
+    def __contains__(self, key: str) -> bool:
+        return key in REFERENCE_ENDPOINTS
+
+    async def load(self, key: str):
+        path, field = REFERENCE_ENDPOINTS[key]
+        status, response_json = await redmine_client.get_json(path, REDMINE_ADMIN_API_KEY)
+        if status != 200:
+            raise RuntimeError(f"{path}: код состояния {status}")
+        self._data[key] = [{'id': item['id'], 'name': item['name']}
+                           for item in response_json[field]]
+
+    async def refresh(self):
+        results = await asyncio.gather(
+            *(self.load(key) for key in REFERENCE_ENDPOINTS), return_exceptions=True)
+        for key, result in zip(REFERENCE_ENDPOINTS, results):
+            if isinstance(result, Exception):
+                logger.error("Не удалось обновить справочник %s: %s",
+                             key, result)
+        logger.info("Справочники Редмайна обновлены: %s",
+                    ', '.join(self._data))
+
+    async def get(self, key: str) -> List[dict]:
+        if key not in self._data:
+            await self.load(key)
+        return self._data[key]
+
+    async def _refresh_forever(self):
+        while True:
+            await asyncio.sleep(self.refresh_seconds)
+            await self.refresh()
+
+    async def start(self):
+        """Прогрев при старте и запуск фонового обновления."""
+        await self.refresh()
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_forever())
+
+
+reference_data = ReferenceDataCache(REFRESH_SECONDS)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import getenv
+from typing import Deque, Dict
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.enums import ParseMode
+from aiogram.methods import (CopyMessage, ForwardMessage, SendAnimation, SendAudio, SendContact,
+                             SendDice, SendDocument, SendGame, SendInvoice, SendLocation,
+                             SendMediaGroup, SendMessage, SendPhoto, SendPoll, SendSticker,
+                             SendVenue, SendVideo, SendVideoNote, SendVoice, TelegramMethod)
+from telegram_limiter import limiter
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+BOT_TOKEN = getenv("BOT_TOKEN")
+CONNECTION_POOL_SIZE = config.getint(
+    'Telegram', 'connection_pool_size', fallback=100)
+# Сколько соединений могут занять уведомления из вебхуков, остальные всегда свободны для ответов
+BULK_CONNECTIONS = config.getint('Telegram', 'bulk_connections', fallback=20)
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+
+# Методы, которые отправляют сообщение в чат и попадают под лимиты Telegram.
+# SendChatAction сюда не входит: индикатор набора лимит сообщений не тратит
+MESSAGE_METHODS = (
+    SendMessage, SendDocument, SendPhoto, SendAudio, SendVideo, SendAnimation, SendVoice,
+    SendVideoNote, SendMediaGroup, SendLocation, SendVenue, SendContact, SendPoll, SendDice,
+    SendSticker, SendGame, SendInvoice, CopyMessage, ForwardMessage,
+)
+
+_lane: ContextVar[str] = ContextVar('telegram_lane', default=INTERACTIVE)
+
+
+@contextmanager
+def bulk_lane():
+    """Запросы к Telegram внутри блока идут в полосе массовых уведомлений."""
+    token = _lane.set(BULK)
+    try:
+        yield
+    finally:
+        _lane.reset(token)
+
+
+class PriorityLanes:
+    """Ограничивает число запросов к Telegram в полёте.
+
+    Ответы пользователям (interactive) занимают любое свободное место и
+    обслуживаются первыми. Уведомления (bulk) занимают не больше bulk_limit
+    мест и ждут, пока есть ожидающие ответы пользователям.
+    """
+
+    def __init__(self, size: int, bulk_limit: int):
+        self.size = size
+        self.bulk_limit = min(bulk_limit, size)
+        self._in_flight = {INTERACTIVE: 0, BULK: 0}
+        self._waiters: Dict[str, Deque[asyncio.Future]] = {
+            INTERACTIVE: deque(), BULK: deque()}
+
+    def _has_room(self, lane: str) -> bool:
+        if sum(self._in_flight.values()) >= self.size:
+            return False
+        if lane == BULK:
+            return self._in_flight[BULK] < self.bulk_limit and not self._waiters[INTERACTIVE]
+        return True
+
+    def _wake_up(self):
+        for lane in (INTERACTIVE, BULK):
+            waiters = self._waiters[lane]
+            while waiters and self._has_room(lane):
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    self._in_flight[lane] += 1
+                    waiter.set_result(None)
+
+    async def acquire(self, lane: str):
+        if not self._waiters[lane] and self._has_room(lane):
+            self._in_flight[lane] += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[lane].append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Место уже выдали, но ждавший отменён - возвращаем его
+                self.release(lane)
+            else:
+                self._waiters[lane].remove(waiter)
+            raise
+
+    def release(self, lane: str):
+        self._in_flight[lane] -= 1
+        self._wake_up()
+
+
+class PriorityLanesMiddleware(BaseRequestMiddleware):
+    def __init__(self, lanes: PriorityLanes):
+        self.lanes = lanes
+
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        lane = _lane.get()
+        if lane == INTERACTIVE and isinstance(method, MESSAGE_METHODS):
+            # Ответ пользователю не ждёт лимитер, но расходует общий бюджет бота,
+            # и уведомлениям из вебхуков придётся подождать
+            limiter.global_bucket.consume()
+
+        await self.lanes.acquire(lane)
+        try:
+            return await make_request(bot, method)
+        finally:
+            self.lanes.release(lane)
+
+
+class PooledAiohttpSession(AiohttpSession):
+    def __init__(self, limit: int, **kwargs):
+        super().__init__(**kwargs)
+        # В aiogram 3.1 размер пула соединений не вынесен в параметры
+        self._connector_init['limit'] = limit
+
+
+# Один бот и одна HTTP сессия на процесс: и для диалогов, и для уведомлений из вебхуков
+bot = Bot(token=BOT_TOKEN, session=PooledAiohttpSession(CONNECTION_POOL_SIZE),
+          parse_mode=ParseMode.HTML)
+bot.session.middleware(PriorityLanesMiddleware(
+    PriorityLanes(CONNECTION_POOL_SIZE, BULK_CONNECTIONS)))
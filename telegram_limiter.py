@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import logging
+from typing import Awaitable, Callable, Dict, TypeVar
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота и ~1 в секунду в один чат
+GLOBAL_RATE = config.getfloat('Telegram', 'global_rate', fallback=30)
+PER_CHAT_RATE = config.getfloat('Telegram', 'per_chat_rate', fallback=1)
+PER_CHAT_BURST = config.getint('Telegram', 'per_chat_burst', fallback=3)
+MAX_CONCURRENCY = config.getint('Telegram', 'max_concurrency', fallback=20)
+MAX_RETRIES = config.getint('Telegram', 'max_retries', fallback=3)
+
+# Сколько чатов держим в памяти, прежде чем чистить простаивающие
+MAX_TRACKED_CHATS = 10000
+
+T = TypeVar('T')
+
+
+class TokenBucket:
+    """Ведро токенов: не больше rate вызовов в секунду с запасом capacity."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = None
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if self.updated_at is not None:
+            self.tokens = min(self.capacity, self.tokens +
+                              (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    @property
+    def idle(self) -> bool:
+        if self._lock.locked():
+            return False
+        self._refill(asyncio.get_running_loop().time())
+        return self.tokens >= self.capacity
+
+    def consume(self):
+        """Берёт токен без ожидания, уходя в долг, который отработают ждущие в acquire."""
+        self._refill(asyncio.get_running_loop().time())
+        self.tokens = max(self.tokens - 1, -self.capacity)
+
+    async def acquire(self):
+        # Ожидающие обслуживаются по очереди (asyncio.Lock - FIFO)
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                self._refill(loop.time())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class ChatLimits:
+    def __init__(self):
+        self.bucket = TokenBucket(PER_CHAT_RATE, PER_CHAT_BURST)
+        # Держится всё время доставки в чат, чтобы сообщения не перемешивались
+        self.lock = asyncio.Lock()
+
+
+class TelegramRateLimiter:
+    def __init__(self):
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        self._chats: Dict[int, ChatLimits] = {}
+
+    def chat(self, chat_id) -> ChatLimits:
+        if len(self._chats) > MAX_TRACKED_CHATS:
+            self._chats = {key: limits for key, limits in self._chats.items()
+                           if limits.lock.locked() or not limits.bucket.idle}
+
+        key = str(chat_id)
+        limits = self._chats.get(key)
+        if limits is None:
+            limits = self._chats[key] = ChatLimits()
+        return limits
+
+    async def call(self, chat_id, method: Callable[..., Awaitable[T]], *args, **kwargs) -> T:
+        """Вызов метода бота с учётом лимитов и повтором при RetryAfter."""
+        chat_bucket = self.chat(chat_id).bucket
+        for attempt in range(1, MAX_RETRIES + 1):
+            await chat_bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await method(*args, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == MAX_RETRIES:
+                    raise
+                logger.warning(
+                    "Флуд-контроль Telegram для чата %s, повтор через %s с", chat_id, e.retry_after)
+                await asyncio.sleep(e.retry_after)
+
+    async def deliver(self, chat_id, send: Callable[[], Awaitable[None]]):
+        """Доставка в один чат: не больше MAX_CONCURRENCY чатов одновременно, по порядку внутри чата."""
+        # Сначала очередь чата: ждущие своей очереди в занятом чате не держат общие слоты
+        async with self.chat(chat_id).lock:
+            async with self.semaphore:
+                await send()
+
+
+limiter = TelegramRateLimiter()
@@ -3,14 +3,17 @@ from os import getenv
 import configparser
 import asyncio
 import logging
-import aiohttp
+from functools import partial
+from typing import Awaitable, Optional
 from aiohttp import web
-from aiohttp.web_exceptions import HTTPClientError
-from aiogram import Bot
-from aiogram.types.input_file import BufferedInputFile
-from aiogram.enums import ParseMode
-from get_api_key import get_api_key_and_login_from_telegram
-from message_handler import message_handler
+from get_api_key import get_api_keys_and_chat_ids
+from message_handler import parse_message, render_message
+from telegram_limiter import limiter
+from telegram_bot import bot, bulk_lane
+from attachments import WebhookAttachment, get_cached_file_ids
+from webhook_queue import QueueFull, enqueue, start_workers
+from issue_cache import issue_cache
+from notification_coalescer import COALESCE_WINDOW_SECONDS, NotificationCoalescer
 
 
 logger = logging.getLogger(__name__)
@@ -19,12 +22,9 @@ LOG_FORMAT = '%s %b "%{Referer}i" "%{User-Agent}i"'
 config = configparser.ConfigParser()
 config.read('config.ini')
 REDMINE_URL = config['Redmine']['url']
-BOT_TOKEN = getenv("BOT_TOKEN")
 REDMINE_ADMIN_API_KEY = getenv("REDMINE_ADMIN_API_KEY")
 SECRET_TOKEN = getenv("SECRET_TOKEN")
 
-bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
-
 
 async def handle_webhook(request):
     token = request.rel_url.query.get('token', None)
@@ -32,50 +32,86 @@ async def handle_webhook(request):
         logger.error("Не верный секретный токен для сервера вебхуков")
         return web.Response(status=403, text="Forbidden")
 
-    data = await request.json()
+    # Доставка идёт в обработчиках очереди, Редмайн ответа не ждёт
+    try:
+        await enqueue(await request.text())
+    except QueueFull as e:
+        logger.error("Очередь вебхуков переполнена: %s", e)
+        return web.Response(status=503, text="Queue is full")
 
-    # Извлечение логинов из recipients
-    message, attachment_ids, attachment_names = message_handler(data)
-    recipient_logins = [recipient['name']
-                        for recipient in data['data']['recipients']]
+    # Плагин Редмайна считает неудачей любой код, кроме 200, хотя доставка ещё впереди
+    return web.Response(status=200, text='Webhook received!')
+
+
+async def notify(chat_id, message: str, attachments: list):
+    await limiter.call(chat_id, bot.send_message, chat_id, message)
+    for attachment in attachments:
+        await attachment.send(bot, chat_id)
 
-    for login in recipient_logins:
-        *_, chat_id_from_db = get_api_key_and_login_from_telegram(
-            login, chat_id=None)
-        if chat_id_from_db:  # срок хранения этого id в redis - сутки
-            await bot.send_message(chat_id_from_db, message)
-            for attach_id, file_name in zip(attachment_ids, attachment_names):
-                bytes_data = await download_file_from_redmine(attach_id, REDMINE_ADMIN_API_KEY)
-                input_file = BufferedInputFile(
-                    file=bytes_data, filename=file_name)
-                await bot.send_document(chat_id_from_db, document=input_file)
 
-    return web.Response(text='Webhook received!')
+async def deliver(chat_id, message: str, attachments: list):
+    # Уведомления уступают соединения и бюджет Telegram ответам пользователям
+    with bulk_lane():
+        await limiter.deliver(chat_id, partial(notify, chat_id, message, attachments))
 
 
-async def download_file_from_redmine(attachment_id, api_key):
-    url = f"{REDMINE_URL}/attachments/download/{attachment_id}"
+coalescer = NotificationCoalescer(COALESCE_WINDOW_SECONDS, deliver)
 
-    headers = {
-        "X-Redmine-API-Key": api_key
-    }
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            if response.status != 200:
-                logger.error(
-                    f"Failed to download attachment. Status: %s {response.status}")
-                raise HTTPClientError(
-                    text=f"Failed to download attachment. Status: {response.status}")
+async def process_webhook(data: dict) -> Optional[Awaitable]:
+    """Рассылка уведомлений по вебхуку.
+
+    При склейке уведомлений возвращает awaitable их отправки: запись очереди
+    подтверждается только после него, чтобы перезапуск в окне не терял уведомления.
+    """
+    # Задача изменилась - закэшированный /show_task больше не актуален
+    issue_cache.invalidate(data['data']['issue']['id'])
+
+    # Извлечение логинов из recipients
+    header, message_parts, attachment_ids, attachment_names = parse_message(
+        data)
+    recipient_logins = [recipient['name']
+                        for recipient in data['data']['recipients']]
+
+    recipients = await get_api_keys_and_chat_ids(recipient_logins)
+    chat_ids = [chat_id_from_db for *_, chat_id_from_db in recipients.values()
+                if chat_id_from_db]
+    if not chat_ids:
+        return
+
+    # Каждое вложение скачивается не больше одного раза на весь вебхук,
+    # а уже загруженные в Telegram отправляются по file_id
+    file_ids = await get_cached_file_ids(attachment_ids)
+    attachments = [WebhookAttachment(attach_id, file_name, REDMINE_ADMIN_API_KEY, file_ids.get(attach_id))
+                   for attach_id, file_name in zip(attachment_ids, attachment_names)]
+
+    # Изменения задачи за окно склеиваются в одно сообщение на получателя
+    if COALESCE_WINDOW_SECONDS > 0:
+        return asyncio.gather(*(coalescer.add(data['data']['issue']['id'], chat_id,
+                                              header, message_parts, attachments)
+                                for chat_id in chat_ids))
+
+    message = render_message(header, message_parts)
+    try:
+        results = await asyncio.gather(
+            *(deliver(chat_id, message, attachments) for chat_id in chat_ids),
+            return_exceptions=True)
+    finally:
+        for attachment in attachments:
+            attachment.close()
+
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            logger.error("Не удалось отправить уведомление в чат %s: %s",
+                         chat_id, result)
 
-            file_content = await response.read()
-            return file_content
 
 app = web.Application()
 app.router.add_post("/v1/redmine", handle_webhook)
 
 
 async def main():
+    await start_workers(process_webhook)
     runner = web.AppRunner(app, access_log_format=LOG_FORMAT)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', 5000)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+import asyncio
+import configparser
+import json
+import logging
+import os
+import socket
+from typing import Awaitable, Callable, List, Optional, Set
+from redis.exceptions import ResponseError
+from get_api_key import async_redis_conn
+
+logger = logging.getLogger(__name__)
+
+config = configparser.ConfigParser()
+config.read('config.ini')
+
+STREAM_KEY = config.get('Webhooks', 'stream_key', fallback='redmine:webhooks')
+GROUP_NAME = config.get('Webhooks', 'group_name', fallback='redmine-bot')
+WORKERS = config.getint('Webhooks', 'workers', fallback=4)
+# Сколько необработанных вебхуков может лежать в очереди, прежде чем отвечать 503
+MAX_BACKLOG = config.getint('Webhooks', 'max_backlog', fallback=10000)
+# Через сколько простоя запись упавшего обработчика забирает другой
+RECLAIM_IDLE_MS = config.getint('Webhooks', 'reclaim_idle_ms', fallback=300000)
+# Вебхук, который столько раз не удалось обработать (процесс падал), уходит в отдельный стрим
+MAX_DELIVERIES = config.getint('Webhooks', 'max_deliveries', fallback=5)
+DEAD_LETTER_KEY = config.get('Webhooks', 'dead_letter_key',
+                             fallback=f"{STREAM_KEY}:dead")
+BATCH_SIZE = 10
+BLOCK_MS = 5000
+RECLAIM_INTERVAL_SECONDS = 30
+
+CONSUMER_PREFIX = f"{socket.gethostname()}-{os.getpid()}"
+
+# Ссылки на задачи обработчиков, чтобы их не собрал сборщик мусора
+worker_tasks: List[asyncio.Task] = []
+# Подтверждения записей, ждущих отложенной отправки
+deferred_acks: Set[asyncio.Task] = set()
+
+
+class QueueFull(Exception):
+    pass
+
+
+async def ensure_group():
+    try:
+        await async_redis_conn.xgroup_create(STREAM_KEY, GROUP_NAME, id='0', mkstream=True)
+    except ResponseError as e:
+        # Группа уже создана другим процессом
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+async def enqueue(payload: str) -> str:
+    """Кладёт необработанное тело вебхука в стрим. Возвращает id записи."""
+    if await async_redis_conn.xlen(STREAM_KEY) >= MAX_BACKLOG:
+        raise QueueFull(f"В очереди {STREAM_KEY} уже {MAX_BACKLOG} вебхуков")
+    return await async_redis_conn.xadd(STREAM_KEY, {'payload': payload})
+
+
+async def process_entries(entries: List, handler: Callable[[dict], Awaitable[Optional[Awaitable]]]):
+    """Обрабатывает записи и подтверждает их.
+
+    Если обработчик вернул awaitable (отложенная отправка), запись
+    подтверждается только после его завершения.
+    """
+    for entry_id, fields in entries:
+        # Записи, удалённые из стрима, пока были в pending, приходят пустыми
+        if fields:
+            try:
+                deferred = await handler(json.loads(fields['payload']))
+            except Exception as e:
+                # Ошибочный вебхук не должен обрабатываться по кругу, поэтому подтверждаем его
+                logger.error("Не удалось обработать вебхук %s: %s",
+                             entry_id, e, exc_info=True)
+            else:
+                if deferred is not None:
+                    task = asyncio.create_task(ack_when_done(entry_id, deferred))
+                    deferred_acks.add(task)
+                    task.add_done_callback(deferred_acks.discard)
+                    continue
+
+        await ack(entry_id)
+
+
+async def ack_when_done(entry_id, deferred: Awaitable):
+    try:
+        await deferred
+    except Exception as e:
+        logger.error("Не удалось обработать вебхук %s: %s", entry_id, e)
+    await ack(entry_id)
+
+
+async def ack(entry_id, dead_fields: dict = None):
+    async with async_redis_conn.pipeline(transaction=True) as pipe:
+        if dead_fields is not None:
+            pipe.xadd(DEAD_LETTER_KEY, {**dead_fields, 'entry_id': entry_id})
+        pipe.xack(STREAM_KEY, GROUP_NAME, entry_id)
+        pipe.xdel(STREAM_KEY, entry_id)
+        await pipe.execute()
+
+
+async def dead_letter(consumer: str, claimed: List) -> List:
+    """Откладывает в DEAD_LETTER_KEY записи, выданные больше MAX_DELIVERIES раз. Возвращает остальные."""
+    pending = await async_redis_conn.xpending_range(
+        STREAM_KEY, GROUP_NAME, min=claimed[0][0], max=claimed[-1][0],
+        count=len(claimed), consumername=consumer)
+    deliveries = {entry['message_id']: entry['times_delivered'] for entry in pending}
+
+    alive = []
+    for entry_id, fields in claimed:
+        if deliveries.get(entry_id, 0) > MAX_DELIVERIES and fields:
+            logger.error("Вебхук %s не обработан за %s попыток, перенесён в %s",
+                         entry_id, MAX_DELIVERIES, DEAD_LETTER_KEY)
+            await ack(entry_id, dead_fields=fields)
+        else:
+            alive.append((entry_id, fields))
+    return alive
+
+
+async def reclaim(consumer: str, handler: Callable[[dict], Awaitable[None]]) -> bool:
+    """Забирает записи, зависшие у упавших обработчиков."""
+    _, claimed, *_ = await async_redis_conn.xautoclaim(
+        STREAM_KEY, GROUP_NAME, consumer, RECLAIM_IDLE_MS, count=BATCH_SIZE)
+    if claimed:
+        logger.warning("%s забрал %s зависших вебхуков",
+                       consumer, len(claimed))
+        await process_entries(await dead_letter(consumer, claimed), handler)
+    return bool(claimed)
+
+
+async def worker(consumer: str, handler: Callable[[dict], Awaitable[None]]):
+    loop = asyncio.get_running_loop()
+    next_reclaim = loop.time()
+    while True:
+        try:
+            if loop.time() >= next_reclaim:
+                if await reclaim(consumer, handler):
+                    continue
+                next_reclaim = loop.time() + RECLAIM_INTERVAL_SECONDS
+
+            response = await async_redis_conn.xreadgroup(
+                GROUP_NAME, consumer, {STREAM_KEY: '>'}, count=BATCH_SIZE, block=BLOCK_MS)
+            for _, entries in response:
+                await process_entries(entries, handler)
+
+        except Exception as e:
+            logger.error("Ошибка обработчика очереди вебхуков %s: %s",
+                         consumer, e)
+            await asyncio.sleep(1)
+
+
+async def start_workers(handler: Callable[[dict], Awaitable[None]]):
+    await ensure_group()
+    worker_tasks.extend(asyncio.create_task(worker(f"{CONSUMER_PREFIX}-{n}", handler))
+                        for n in range(WORKERS))
+    logger.info("Запущено %s обработчиков очереди вебхуков", WORKERS)